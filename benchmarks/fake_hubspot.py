@@ -0,0 +1,321 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Local stand-in for the Hubspot CRM v3 objects API, used to benchmark the
+plugin without calling Hubspot.
+
+Serves contacts and companies generated from a seed, on the search, list and
+batch read endpoints, with a configurable latency and error rate.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIRSTNAMES = ['Alice', 'Bruno', 'Chloé', 'David', 'Émilie', 'François', 'Gaëlle', 'Hugo', 'Inès', 'Jules']
+LASTNAMES = ['Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit', 'Durand', 'Leroy', 'Moreau']
+COMPANY_WORDS = ['Atelier', 'Groupe', 'Studio', 'Conseil', 'Services', 'Industries', 'Solutions', 'Partners']
+
+# One contact in `COMPANYLESS_CONTACTS` has no company
+COMPANYLESS_CONTACTS = 5
+
+OBJECT_PATH = re.compile(r'^/crm/v3/objects/(contacts|companies)(/search|/batch/read)?/?$')
+ASSOCIATION_PATH = re.compile(r'^/crm/v3/associations/(contacts|companies)/(contacts|companies)/batch/read/?$')
+
+
+def _iso(millis):
+    return datetime.fromtimestamp(millis / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def contact_number(index):
+    return '+336{:08d}'.format(index)
+
+
+def company_number(index):
+    return '+331{:08d}'.format(index)
+
+
+class Dataset:
+
+    def __init__(self, contacts, companies, seed=0):
+        rng = random.Random(seed)
+        now = int(time.time() * 1000)
+        self.objects = {'contacts': {}, 'companies': {}}
+        self.associations = {}
+
+        for i in range(contacts):
+            uid = str(100000 + i)
+            properties = {
+                'hs_object_id': uid,
+                'firstname': rng.choice(FIRSTNAMES),
+                'lastname': rng.choice(LASTNAMES),
+                'email': 'contact{}@example.com'.format(i),
+                'phone': contact_number(i) if i % 3 else None,
+                'mobilephone': contact_number(i),
+                'country': 'France',
+            }
+            self.objects['contacts'][uid] = self._object(uid, properties, now - rng.randrange(86400000))
+
+        for i in range(companies):
+            uid = str(900000 + i)
+            properties = {
+                'hs_object_id': uid,
+                'name': '{} {}'.format(rng.choice(COMPANY_WORDS), rng.choice(LASTNAMES)),
+                'phone': company_number(i),
+                'country': 'FR',
+            }
+            self.objects['companies'][uid] = self._object(uid, properties, now - rng.randrange(86400000))
+
+        # Most contacts work for a company, the primary one is also their `associatedcompanyid` property
+        company_ids = list(self.objects['companies'])
+        if company_ids:
+            for i, (uid, contact) in enumerate(self.objects['contacts'].items()):
+                if i % COMPANYLESS_CONTACTS == 0:
+                    continue
+                self.associations[uid] = rng.choice(company_ids)
+                contact['properties']['associatedcompanyid'] = self.associations[uid]
+
+    def _object(self, uid, properties, updated_at):
+        return {
+            'id': uid,
+            'properties': properties,
+            'createdAt': _iso(updated_at),
+            'updatedAt': _iso(updated_at),
+            'updated_at_ms': updated_at,
+            'archived': False,
+        }
+
+
+def _public(obj, properties):
+    return {
+        'id': obj['id'],
+        'properties': {name: obj['properties'].get(name) for name in properties} if properties else obj['properties'],
+        'createdAt': obj['createdAt'],
+        'updatedAt': obj['updatedAt'],
+        'archived': obj['archived'],
+    }
+
+
+def _match_filter(obj, filter_):
+    operator = filter_.get('operator')
+    name = filter_.get('propertyName')
+    if name in ('lastmodifieddate', 'hs_lastmodifieddate'):
+        value = obj['updated_at_ms']
+    else:
+        value = obj['properties'].get(name)
+
+    if operator == 'EQ':
+        return value is not None and str(value) == filter_.get('value')
+    if operator == 'IN':
+        return value in filter_.get('values', [])
+    if operator == 'CONTAINS_TOKEN':
+        token = filter_.get('value', '').strip('*').lower()
+        return value is not None and token in str(value).lower()
+    if operator in ('GT', 'GTE'):
+        threshold = int(filter_.get('value'))
+        return value is not None and (value > threshold if operator == 'GT' else value >= threshold)
+    return False
+
+
+def _match(obj, filter_groups):
+    if not filter_groups:
+        return True
+    return any(all(_match_filter(obj, f) for f in group.get('filters', [])) for group in filter_groups)
+
+
+class FakeHubspot:
+
+    def __init__(self, dataset, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=0):
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.calls = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(_Handler):
+            hubspot = fake
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    def delay(self):
+        with self._lock:
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            draw = self._rng.random()
+        time.sleep(delay)
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def search(self, object_type, body):
+        objects = self.dataset.objects[object_type].values()
+        matches = [obj for obj in objects if _match(obj, body.get('filterGroups'))]
+        if body.get('sorts'):
+            matches.sort(key=lambda obj: obj['updated_at_ms'])
+        after = int(body.get('after') or 0)
+        limit = int(body.get('limit') or 10)
+        page = matches[after:after + limit]
+        response = {
+            'total': len(matches),
+            'results': [_public(obj, body.get('properties')) for obj in page],
+        }
+        if after + limit < len(matches):
+            response['paging'] = {'next': {'after': str(after + limit)}}
+        return response
+
+    def list(self, object_type, query):
+        # hubspot-api-client sends booleans as "True" and "False"
+        archived = query.get('archived', ['false'])[0].lower() == 'true'
+        objects = [obj for obj in self.dataset.objects[object_type].values() if obj['archived'] == archived]
+        after = int(query.get('after', ['0'])[0] or 0)
+        limit = int(query.get('limit', ['10'])[0])
+        properties = ','.join(query.get('properties', [])).split(',') if query.get('properties') else None
+        page = objects[after:after + limit]
+        response = {'results': [_public(obj, properties) for obj in page]}
+        if after + limit < len(objects):
+            response['paging'] = {'next': {'after': str(after + limit)}}
+        return response
+
+    def batch_read(self, object_type, body):
+        objects = self.dataset.objects[object_type]
+        now = _iso(int(time.time() * 1000))
+        results = [
+            _public(objects[item['id']], body.get('properties'))
+            for item in body.get('inputs', []) if item['id'] in objects
+        ]
+        return {'status': 'COMPLETE', 'results': results, 'startedAt': now, 'completedAt': now}
+
+    def associations(self, body):
+        now = _iso(int(time.time() * 1000))
+        results = []
+        for item in body.get('inputs', []):
+            company = self.dataset.associations.get(item['id'])
+            if company is not None:
+                results.append({
+                    'from': {'id': item['id']},
+                    'to': [{'id': company, 'type': 'contact_to_company'}],
+                })
+        return {'status': 'COMPLETE', 'results': results, 'startedAt': now, 'completedAt': now}
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    hubspot = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = OBJECT_PATH.match(url.path)
+        if not match or match.group(2):
+            return self._reply(404, {'message': 'not found'})
+        self._handle('list', lambda: self.hubspot.list(match.group(1), parse_qs(url.query)))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        match = ASSOCIATION_PATH.match(url.path)
+        if match:
+            return self._handle('associations', lambda: self.hubspot.associations(body))
+
+        match = OBJECT_PATH.match(url.path)
+        if not match or not match.group(2):
+            return self._reply(404, {'message': 'not found'})
+
+        object_type, action = match.groups()
+        if action == '/search':
+            self._handle('search', lambda: self.hubspot.search(object_type, body))
+        else:
+            self._handle('batch_read', lambda: self.hubspot.batch_read(object_type, body))
+
+    def _handle(self, endpoint, handler):
+        self.hubspot.count(endpoint)
+        error = self.hubspot.delay()
+        if error == 429:
+            return self._reply(429, {'message': 'rate limited'}, {'Retry-After': '1'})
+        if error:
+            return self._reply(error, {'message': 'internal error'})
+        self._reply(200, handler())
+
+    def _reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--contacts', type=int, default=10000)
+    parser.add_argument('--companies', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.15, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of 429 responses')
+    args = parser.parse_args()
+
+    fake = FakeHubspot(
+        Dataset(args.contacts, args.companies),
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+    ).start(port=args.port)
+    print('Fake Hubspot listening on {}'.format(fake.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
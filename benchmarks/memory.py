@@ -0,0 +1,98 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Measure the memory used per record by the mirror, on the fake Hubspot dataset:
+records stored as property dicts, records packed by their `RecordLayout`, and
+the whole mirror with its phone and search indexes.
+
+Only phonenumbers needs to be importable:
+
+    PYTHONPATH=. python3 benchmarks/memory.py --contacts 100000
+"""
+
+import argparse
+import gc
+import json
+import tracemalloc
+
+from fake_hubspot import Dataset
+
+from wazo_plugin_hubspot.dird import phone
+from wazo_plugin_hubspot.dird.mirror import Mirror
+from wazo_plugin_hubspot.dird.record import RecordLayout
+
+FIELDS = {
+    'contacts': ['hs_object_id', 'country', 'phone', 'mobilephone', 'firstname', 'lastname'],
+    'companies': ['hs_object_id', 'country', 'phone', 'name'],
+}
+PHONE_FIELDS = {'contacts': ['phone', 'mobilephone'], 'companies': ['phone']}
+NAME_FIELDS = {'contacts': ['firstname', 'lastname'], 'companies': ['name']}
+
+
+def measure(build):
+    """Return the bytes still allocated by the result of `build`, and the result"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def prepare(properties):
+    properties = dict(properties)
+    region = phone.region_for_country(properties.get('country'), 'FR')
+    for field in ('phone', 'mobilephone'):
+        if properties.get(field):
+            properties[field] = phone.to_international(properties[field], region) or properties[field]
+    return properties
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--contacts', type=int, default=50000)
+    parser.add_argument('--companies', type=int, default=5000)
+    args = parser.parse_args()
+
+    dataset = Dataset(args.contacts, args.companies)
+    # Projected and prepared once, as the mirror receives them from the sync
+    records = [
+        (object_type, uid, prepare({field: obj['properties'].get(field) for field in FIELDS[object_type]}))
+        for object_type, objects in dataset.objects.items()
+        for uid, obj in objects.items()
+    ]
+    count = len(records)
+    layouts = {object_type: RecordLayout(fields, 'hs_object_id', ['country']) for object_type, fields in FIELDS.items()}
+
+    dicts, _ = measure(lambda: {(object_type, uid): dict(properties) for object_type, uid, properties in records})
+    packed, _ = measure(
+        lambda: {(object_type, uid): layouts[object_type].pack(properties) for object_type, uid, properties in records}
+    )
+
+    def build_mirror():
+        mirror = Mirror(dict, lambda number: phone.to_e164(number, 'FR'), layouts, PHONE_FIELDS, NAME_FIELDS)
+        mirror.replace(records)
+        return mirror
+
+    total, mirror = measure(build_mirror)
+
+    print(
+        json.dumps(
+            {
+                'records': count,
+                'dict_bytes_per_record': dicts // count,
+                'packed_bytes_per_record': packed // count,
+                'mirror_bytes_per_record': total // count,
+                # Estimated by the mirror for GET stats, to compare with the measure above
+                'mirror_record_size': mirror.record_size(),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Benchmark HubspotBackend search, first_match and list against a local fake
+Hubspot, in live, cached and mirrored modes.
+
+wazo-dird and hubspot-api-client must be importable, e.g. run it on a Wazo
+host or in the wazo-dird virtualenv:
+
+    PYTHONPATH=. python3 benchmarks/run.py --modes live cached mirror --contacts 20000
+"""
+
+import argparse
+import json
+import math
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_hubspot import LASTNAMES, Dataset, FakeHubspot, company_number, contact_number
+
+from wazo_plugin_hubspot.dird.plugin import HubspotBackend
+
+MODES = {
+    'live': {'cache': {'enabled': False}, 'mirror': {'enabled': False}},
+    'cached': {'cache': {'enabled': True}, 'mirror': {'enabled': False}},
+    # Without a snapshot, every run starts from a full sync of the fake dataset
+    'mirror': {'cache': {'enabled': True}, 'mirror': {'enabled': True, 'refresh_interval': 3600, 'snapshot': False}},
+}
+
+OPERATIONS = ['first_match', 'search', 'list']
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def make_backend(url, mode, args):
+    config = {
+        'name': 'benchmark-{}'.format(mode),
+        'uuid': 'benchmark-{}'.format(mode),
+        'access_token': 'fake-token',
+        'api_url': url,
+        'default_region': 'FR',
+        'timeout': args.timeout,
+        'format_columns': {
+            'name': '{firstname} {lastname} {name}',
+            'phone': '{phone}',
+            'mobile': '{mobilephone}',
+            'company': '{company_name}',
+        },
+        'first_matched_columns': ['phone', 'mobile'],
+        'searched_columns': ['name', 'phone', 'mobile'],
+        'rate_limit': {'enabled': args.rate_limit},
+        'pool': {'transport': args.transport},
+        'associations': {'enabled': True},
+    }
+    config.update(MODES[mode])
+    backend = HubspotBackend()
+    backend.load({'config': config})
+    return backend
+
+
+def wait_for_mirror(backend, timeout):
+    deadline = time.monotonic() + timeout
+    while not backend.stats().get('mirror', {}).get('ready'):
+        if time.monotonic() > deadline:
+            raise RuntimeError('mirror was not ready after {}s'.format(timeout))
+        time.sleep(0.1)
+
+
+def check_companies(backend, dataset):
+    """Fail unless contacts get the fields of their company, otherwise associations are not measured"""
+    uid = next(iter(dataset.associations))
+    company = dataset.objects['companies'][dataset.associations[uid]]['properties']
+    contact = backend.first_match(contact_number(int(uid) - 100000))
+    favorite = next(iter(backend.list([uid], {})), None)
+    for name, result in (('first_match', contact), ('list', favorite)):
+        if result is None:
+            raise RuntimeError('{} did not find contact {}'.format(name, uid))
+        fields = result.fields
+        expected = (company['hs_object_id'], company['name'])
+        if (fields.get('company_hs_object_id'), fields.get('company_name')) != expected:
+            raise RuntimeError('{} returned contact {} without its company fields: {}'.format(name, uid, fields))
+
+
+class Workload:
+
+    def __init__(self, args):
+        self._rng = random.Random(args.seed)
+        self._args = args
+        known = [contact_number(i) for i in range(min(args.callers, args.contacts))]
+        unknown = ['+449{:08d}'.format(i) for i in range(args.callers)]
+        self._callers = [
+            self._rng.choice(unknown) if self._rng.random() < args.unknown_ratio else self._rng.choice(known)
+            for _ in range(args.callers)
+        ]
+        self._callers += [company_number(i) for i in range(min(args.callers // 10, args.companies))]
+        self._terms = LASTNAMES + [contact_number(i)[-4:] for i in range(10)]
+        self._uids = [str(100000 + i) for i in range(args.contacts)] + [str(900000 + i) for i in range(args.companies)]
+
+    def call(self, backend, operation):
+        if operation == 'first_match':
+            return backend.first_match(self._rng.choice(self._callers))
+        if operation == 'search':
+            return list(backend.search(self._rng.choice(self._terms)))
+        return list(backend.list(self._rng.sample(self._uids, min(self._args.favorites, len(self._uids))), {}))
+
+
+def run(backend, fake, workload, operation, args):
+    fake.reset_calls()
+    latencies = []
+    errors = 0
+    hits = 0
+
+    def timed_call(_):
+        started_at = time.perf_counter()
+        try:
+            result = workload.call(backend, operation)
+        except Exception:
+            return None
+        return time.perf_counter() - started_at, bool(result)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for outcome in executor.map(timed_call, range(args.requests)):
+            if outcome is None:
+                errors += 1
+                continue
+            latency, hit = outcome
+            latencies.append(latency)
+            hits += hit
+    elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    return {
+        'requests': args.requests,
+        'errors': errors,
+        # Calls answered with at least one result: an empty mirror answers fast, but misses
+        'hits': hits,
+        'misses': args.requests - errors - hits,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'throughput': round(args.requests / elapsed, 1),
+        'upstream_calls': dict(fake.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=sorted(MODES))
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument('--contacts', type=int, default=10000)
+    parser.add_argument('--companies', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.15, help='seconds added to every fake response')
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of fake 429 responses')
+    parser.add_argument('--requests', type=int, default=500, help='requests per mode and operation')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--callers', type=int, default=200, help='distinct caller numbers')
+    parser.add_argument('--unknown-ratio', type=float, default=0.5, help='share of callers unknown to Hubspot')
+    parser.add_argument('--favorites', type=int, default=20, help='uids per list call')
+    parser.add_argument('--timeout', type=float, default=3.0)
+    parser.add_argument('--rate-limit', action='store_true', help='enable the client side rate limiter')
+    parser.add_argument('--transport', choices=['sync', 'async'], default='sync', help='async needs aiohttp')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    dataset = Dataset(args.contacts, args.companies, seed=args.seed)
+    fake = FakeHubspot(
+        dataset,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    ).start()
+
+    report = {}
+    try:
+        for mode in args.modes:
+            backend = make_backend(fake.url, mode, args)
+            try:
+                if MODES[mode]['mirror']['enabled']:
+                    wait_for_mirror(backend, timeout=600)
+                # Injected errors would fail the check at random
+                if dataset.associations and not (args.error_rate or args.rate_limit_rate):
+                    check_companies(backend, dataset)
+                workload = Workload(args)
+                for operation in args.operations:
+                    report[(mode, operation)] = run(backend, fake, workload, operation, args)
+            finally:
+                backend.unload()
+    finally:
+        fake.stop()
+
+    if args.json:
+        print(json.dumps([dict(mode=mode, operation=operation, **result) for (mode, operation), result in report.items()], indent=2))
+        return
+
+    print('{:<8} {:<12} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9} {:>10}  upstream calls'.format(
+        'mode', 'operation', 'errors', 'hits', 'misses', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'
+    ))
+    for (mode, operation), result in report.items():
+        print('{:<8} {:<12} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9} {:>10}  {}'.format(
+            mode,
+            operation,
+            result['errors'],
+            result['hits'],
+            result['misses'],
+            result['p50_ms'],
+            result['p95_ms'],
+            result['p99_ms'],
+            result['throughput'],
+            ', '.join('{}={}'.format(name, count) for name, count in sorted(result['upstream_calls'].items())) or '-',
+        ))
+
+
+if __name__ == '__main__':
+    main()
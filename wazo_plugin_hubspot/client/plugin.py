@@ -7,3 +7,37 @@ from wazo_dird_client.commands.helpers.base_source_command import SourceCommand
 class HubspotCommand(SourceCommand):
 
     resource = 'backends/hubspot/sources'
+
+    def get_stats(self, source_uuid, tenant_uuid=None):
+        headers = self.build_headers(tenant_uuid)
+        url = '/'.join([self.base_url, source_uuid, 'stats'])
+        r = self.session.get(url, headers=headers)
+        self.raise_from_response(r)
+        return r.json()
+
+    def get_metrics(self, source_uuid, tenant_uuid=None):
+        headers = self.build_headers(tenant_uuid)
+        headers['Accept'] = 'text/plain'
+        url = '/'.join([self.base_url, source_uuid, 'metrics'])
+        r = self.session.get(url, headers=headers)
+        self.raise_from_response(r)
+        return r.text
+
+    def flush_cache(self, source_uuid, tenant_uuid=None):
+        headers = self.build_headers(tenant_uuid)
+        url = '/'.join([self.base_url, source_uuid, 'cache'])
+        r = self.session.delete(url, headers=headers)
+        self.raise_from_response(r)
+
+    def warm_cache(self, source_uuid, numbers, tenant_uuid=None):
+        headers = self.build_headers(tenant_uuid)
+        url = '/'.join([self.base_url, source_uuid, 'cache', 'warm'])
+        r = self.session.put(url, json={'numbers': numbers}, headers=headers)
+        self.raise_from_response(r)
+        return r.json()
+
+    def resync_mirror(self, source_uuid, tenant_uuid=None):
+        headers = self.build_headers(tenant_uuid)
+        url = '/'.join([self.base_url, source_uuid, 'mirror', 'resync'])
+        r = self.session.put(url, headers=headers)
+        self.raise_from_response(r)
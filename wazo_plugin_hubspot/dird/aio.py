@@ -0,0 +1,124 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import logging
+import ssl
+import threading
+
+import certifi
+
+from collections import namedtuple
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (500, 502, 503, 504)
+RETRY_BACKOFF = 0.2
+
+# Attributes of the SDK responses used by the backend
+SimpleObject = namedtuple('SimpleObject', 'id properties')
+Response = namedtuple('Response', 'results paging')
+Paging = namedtuple('Paging', 'next')
+NextPage = namedtuple('NextPage', 'after')
+
+
+class TransportError(Exception):
+
+    def __init__(self, status, reason, headers=None, body=None):
+        super().__init__('({}) {}: {}'.format(status, reason, body))
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+def available():
+    return aiohttp is not None
+
+
+class AsyncTransport:
+    """
+    Sends requests to the Hubspot CRM API with aiohttp, on an event loop run
+    by a dedicated thread.
+
+    Coroutines are submitted from any thread with `submit`, so many lookups
+    are in flight at once on one pool of `size` keep-alive connections,
+    without holding a thread each.
+    """
+
+    def __init__(self, access_token, api_url, pool_config):
+        self._access_token = access_token
+        self._api_url = api_url.rstrip('/')
+        self._size = pool_config.get('size', 10)
+        self._keep_alive = pool_config.get('keep_alive', True)
+        self._connect_timeout = pool_config.get('connect_timeout', 1.0)
+        self._retries = pool_config.get('retries', 2)
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='hubspot-aio', daemon=True)
+        self._thread.start()
+        self._session = self.submit(self._open_session()).result()
+
+    def submit(self, coroutine):
+        """Schedule `coroutine` on the event loop, return a `concurrent.futures.Future`"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def post(self, path, body, timeout, params=None):
+        """Return the decoded JSON answer of a POST on `path`, retrying on server and connection errors"""
+        connect_timeout, read_timeout = timeout
+        client_timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        url = self._api_url + path
+        for attempt in range(self._retries + 1):
+            last_attempt = attempt == self._retries
+            try:
+                async with self._session.post(url, json=body, params=params, timeout=client_timeout) as response:
+                    if response.status in RETRY_STATUSES and not last_attempt:
+                        await response.read()
+                    elif response.status >= 400:
+                        raise TransportError(response.status, response.reason, response.headers, await response.text())
+                    else:
+                        return await response.json(content_type=None)
+            except aiohttp.ClientConnectionError as e:
+                if last_attempt:
+                    raise TransportError(0, 'Connection error', body=str(e)) from e
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        try:
+            self.submit(self._session.close()).result(timeout=self._connect_timeout)
+        except Exception as e:
+            logger.warning('Could not close Hubspot HTTP session: %s', e)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self._size,
+            force_close=not self._keep_alive,
+            ssl=ssl.create_default_context(cafile=certifi.where()),
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers={'Authorization': 'Bearer {}'.format(self._access_token)},
+            raise_for_status=False,
+        )
+
+
+def parse_objects(payload):
+    after = ((payload.get('paging') or {}).get('next') or {}).get('after')
+    return Response(
+        [SimpleObject(result['id'], result.get('properties') or {}) for result in payload.get('results', [])],
+        Paging(NextPage(after)) if after is not None else None,
+    )
+
+
+def parse_associations(payload):
+    return {result['from']['id']: [to['id'] for to in result.get('to', [])] for result in payload.get('results', [])}
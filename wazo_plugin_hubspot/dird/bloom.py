@@ -0,0 +1,125 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import math
+import threading
+
+
+class BloomFilter:
+    """
+    Set of strings answering "maybe present" or "definitely absent", using
+    about 10 bits per entry for a 1% false positive rate. Entries cannot be
+    removed, and each must be added once only: `entries` counts the adds.
+    """
+
+    def __init__(self, capacity, false_positive_rate):
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.bits_set = 0
+        self.entries = 0
+
+    def add(self, value):
+        for position in self._positions(value):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self._bits[byte] & mask:
+                self._bits[byte] |= mask
+                self.bits_set += 1
+        self.entries += 1
+
+    def __contains__(self, value):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def false_positive_rate(self):
+        """Return the probability that an absent value is reported present, given the bits already set"""
+        return (self.bits_set / self.size) ** self.hashes
+
+    def memory(self):
+        return len(self._bits)
+
+    def _positions(self, value):
+        # Double hashing: k positions out of two 64 bits hashes
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+
+class NumberFilter:
+    """
+    Phone numbers of every Hubspot contact and company, in a `BloomFilter`,
+    to tell at once that a caller is unknown without calling Hubspot.
+
+    It is kept up to date by a `MirrorSynchronizer`, like a `Mirror`, but
+    only stores numbers. The filter is sized on a full sync, for twice the
+    numbers then known. Removed records and replaced numbers stay in it as
+    false positives until the next full sync, which rebuilds it.
+    """
+
+    def __init__(self, prepare, normalize, phone_fields, false_positive_rate, min_capacity):
+        self._prepare = prepare
+        self._normalize = normalize
+        self._phone_fields = phone_fields
+        self._false_positive_rate = false_positive_rate
+        self._min_capacity = min_capacity
+        self._filter = BloomFilter(min_capacity, false_positive_rate)
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def __contains__(self, number):
+        return number in self._filter
+
+    def upsert(self, object_type, uid, properties):
+        """Add the numbers of a record, return its `(object_type, uid, properties, numbers)` item"""
+        item = self._item(object_type, uid, properties)
+        with self._lock:
+            for number in item[3]:
+                # A number already known, or a false positive, is not counted twice
+                if number not in self._filter:
+                    self._filter.add(number)
+        return item
+
+    def remove(self, object_type, uid):
+        pass
+
+    def replace(self, records):
+        """Replace the numbers with the ones of `records`, return an iterator over their items"""
+        numbers = set()
+        for object_type, _, properties in records:
+            numbers.update(self._numbers(object_type, self._prepare(properties)))
+
+        new_filter = BloomFilter(max(2 * len(numbers), self._min_capacity), self._false_positive_rate)
+        for number in numbers:
+            new_filter.add(number)
+        with self._lock:
+            self._filter = new_filter
+            self.ready = True
+        return (self._item(object_type, uid, properties) for object_type, uid, properties in records)
+
+    def as_dict(self):
+        bloom = self._filter
+        return {
+            'ready': self.ready,
+            'numbers': bloom.entries,
+            'bytes': bloom.memory(),
+            'hashes': bloom.hashes,
+            'false_positive_rate': round(bloom.false_positive_rate(), 6),
+        }
+
+    def _item(self, object_type, uid, properties):
+        # Only the phone numbers are kept, formatted, in the snapshot of the filter
+        properties = self._prepare(properties)
+        phone_properties = {field: properties.get(field) for field in self._phone_fields[object_type]}
+        return object_type, uid, phone_properties, self._numbers(object_type, phone_properties)
+
+    def _numbers(self, object_type, properties):
+        numbers = set()
+        for field in self._phone_fields[object_type]:
+            if properties.get(field):
+                number = self._normalize(properties[field])
+                if number:
+                    numbers.add(number)
+        return numbers
@@ -0,0 +1,80 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """
+    Stops calling Hubspot after `failure_threshold` consecutive failures.
+
+    Once open, calls are refused for `cooldown` seconds. Then a single trial
+    call is let through (half-open): the breaker closes if it succeeds, and
+    opens again for another cooldown if it fails.
+    """
+
+    def __init__(self, name, failure_threshold, cooldown, clock=time.monotonic):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self.state = CLOSED
+
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self._clock() - self._opened_at >= self._cooldown:
+                self.state = HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != CLOSED:
+                logger.info('Hubspot is answering again on source %s, closing circuit breaker', self._name)
+                self.state = CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self._failure_threshold):
+                logger.warning(
+                    'Hubspot failed %s times on source %s, not calling it for %ss',
+                    self._failures, self._name, self._cooldown,
+                )
+                self.state = OPEN
+                self._opened_at = self._clock()
+                self.opened += 1
+
+    def record_ignored(self):
+        """The call let through did not reach Hubspot, e.g. it was throttled locally: let the next one through"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                # Its cooldown has elapsed already
+                self.state = OPEN
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self._failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+            }
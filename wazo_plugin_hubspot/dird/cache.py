@@ -0,0 +1,120 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MISS = object()
+
+
+class LookupCache:
+    """
+    Bounded in-memory cache used for reverse lookups.
+
+    Entries expire after `ttl` seconds, or `negative_ttl` seconds when the
+    cached value is `None` (no match). When `max_entries` is reached, the least
+    recently used entry is evicted.
+
+    `tags` returns the tags of a value, e.g. the uids of the records it holds,
+    so that every entry of a record is invalidated at once.
+    """
+
+    def __init__(self, max_entries, ttl, negative_ttl, clock=time.monotonic, tags=None):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self._tags = tags or _no_tags
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISS
+
+            value, expires_at = entry
+            if expires_at <= self._clock():
+                # Expired entries are kept until evicted, see get_stale
+                self.misses += 1
+                return MISS
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key):
+        """Return the last value stored for `key`, even if it has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISS
+            return entry[0]
+
+    def is_fresh(self, key):
+        """Return whether `key` has an entry that has not expired, without counting a hit or a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > self._clock()
+
+    def set(self, key, value):
+        ttl = self._ttl if value is not None else self._negative_ttl
+        if ttl <= 0 or self._max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, self._clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        """Remove the entries whose value matches `predicate`, return how many"""
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def invalidate_tagged(self, tags):
+        """Remove the entries having one of `tags`, return how many"""
+        tags = set(tags)
+        return self.invalidate_if(lambda value: not tags.isdisjoint(self._tags(value)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        self.clear()
+
+    def as_dict(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _no_tags(value):
+    return ()
@@ -0,0 +1,388 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import logging
+import socket
+import threading
+
+import certifi
+import urllib3
+
+from hubspot import HubSpot
+from hubspot.crm.associations import ApiException as AssociationsApiException
+from hubspot.crm.associations import BatchInputPublicObjectId, PublicObjectId
+from hubspot.crm.companies import ApiException as CompaniesApiException
+from hubspot.crm.contacts import ApiException as ContactsApiException
+from hubspot.crm.contacts import BatchReadInputSimplePublicObjectId, SimplePublicObjectId
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from . import aio
+from .mirror import COMPANIES, CONTACTS
+from .ratelimit import PRIORITY_CALL, RateLimitedError, get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# Each API of the SDK raises its own ApiException class, unrelated to the others
+API_ERRORS = (
+    ContactsApiException,
+    CompaniesApiException,
+    AssociationsApiException,
+)
+
+# Errors of a Hubspot call that are logged rather than propagated to wazo-dird
+UPSTREAM_ERRORS = API_ERRORS + (
+    urllib3.exceptions.HTTPError,
+    RateLimitedError,
+    aio.TransportError,
+    asyncio.TimeoutError,
+)
+
+DEFAULT_RETRY_AFTER = 1
+
+API_URL = 'https://api.hubapi.com'
+
+ASSOCIATIONS = 'associations'
+
+
+class PoolStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.new_connections = 0
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self):
+        return {
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'new_connections': self.new_connections,
+        }
+
+
+class _MeteredPoolMixin:
+
+    stats = None
+    keep_alive = True
+
+    def _get_conn(self, timeout=None):
+        if self.stats is not None:
+            self.stats.increment('checkouts')
+            # Every connection is in use: the request waits for one to be released
+            if self.pool is not None and self.pool.empty():
+                self.stats.increment('waits')
+        return super()._get_conn(timeout=timeout)
+
+    def _new_conn(self):
+        if self.stats is not None:
+            self.stats.increment('new_connections')
+        return super()._new_conn()
+
+    def _put_conn(self, conn):
+        if not self.keep_alive and conn is not None:
+            conn.close()
+        super()._put_conn(conn)
+
+
+class _MeteredHTTPConnectionPool(_MeteredPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _MeteredHTTPSConnectionPool(_MeteredPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _MeteredPoolManager(urllib3.PoolManager):
+
+    def __init__(self, stats, keep_alive, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+        self.keep_alive = keep_alive
+        self.pool_classes_by_scheme = {
+            'http': _MeteredHTTPConnectionPool,
+            'https': _MeteredHTTPSConnectionPool,
+        }
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context=request_context)
+        pool.stats = self.stats
+        pool.keep_alive = self.keep_alive
+        return pool
+
+
+class HubspotClient:
+    """
+    Hubspot CRM API objects sharing a single pool of keep-alive connections.
+
+    Every call goes through this class, with the connect and read timeouts of
+    the pool configuration, and waits for the rate limiters shared by the
+    sources using the same token.
+
+    With the `async` transport, searches and batch reads are also available as
+    coroutines, run by an `AsyncTransport` on its own event loop and pool.
+    """
+
+    def __init__(self, access_token, api_url, pool_config, rate_limit_config):
+        self.stats = PoolStats()
+        self._api_url = api_url
+        self._search_limiter = None
+        self._api_limiter = None
+        if rate_limit_config.get('enabled', True):
+            reserve = rate_limit_config.get('reserve', 1)
+            self._search_limiter = get_rate_limiter(
+                access_token, 'search', rate_limit_config.get('search_rate', 4), reserve
+            )
+            self._api_limiter = get_rate_limiter(
+                access_token, 'api', rate_limit_config.get('api_rate', 10), reserve
+            )
+
+        self._request_timeout = (
+            pool_config.get('connect_timeout', 1.0),
+            pool_config.get('read_timeout', 3.0),
+        )
+
+        keep_alive = pool_config.get('keep_alive', True)
+        socket_options = list(HTTPConnection.default_socket_options)
+        if keep_alive:
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+
+        self._pool_manager = _MeteredPoolManager(
+            self.stats,
+            keep_alive,
+            num_pools=4,
+            maxsize=pool_config.get('size', 10),
+            block=True,
+            socket_options=socket_options,
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=certifi.where(),
+            retries=Retry(
+                total=pool_config.get('retries', 2),
+                backoff_factor=0.2,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=None,
+                raise_on_status=False,
+            ),
+        )
+
+        self._transport = None
+        if pool_config.get('transport') == 'async':
+            if aio.available():
+                self._transport = aio.AsyncTransport(access_token, api_url, pool_config)
+            else:
+                logger.error('aiohttp is not installed, using the sync transport')
+
+        self._hubspot = HubSpot(access_token=access_token)
+        self._apis = {}
+        self._lock = threading.Lock()
+
+    @property
+    def is_async(self):
+        return self._transport is not None
+
+    def submit(self, coroutine):
+        """Run `coroutine` on the event loop of the async transport, return a future"""
+        return self._transport.submit(coroutine)
+
+    def search(self, object_type, request, timeout=None, priority=PRIORITY_CALL):
+        return self._call(
+            self._search_limiter,
+            priority,
+            timeout,
+            self._api(object_type, 'search_api').do_search,
+            public_object_search_request=request,
+            _request_timeout=self._timeout(timeout),
+        )
+
+    async def search_async(self, object_type, request, timeout=None, priority=PRIORITY_CALL):
+        api_client = self._api(object_type, 'search_api').api_client
+        return await self._call_async(
+            self._search_limiter,
+            priority,
+            timeout,
+            '/crm/v3/objects/{}/search'.format(object_type),
+            api_client.sanitize_for_serialization(request),
+        )
+
+    def get_page(self, object_type, priority=PRIORITY_CALL, **kwargs):
+        return self._call(
+            self._api_limiter,
+            priority,
+            None,
+            self._api(object_type, 'basic_api').get_page,
+            _request_timeout=self._request_timeout,
+            **kwargs
+        )
+
+    def batch_read(self, object_type, ids, properties, timeout=None, priority=PRIORITY_CALL):
+        return self._call(
+            self._api_limiter,
+            priority,
+            timeout,
+            self._api(object_type, 'batch_api').read,
+            batch_read_input_simple_public_object_id=BatchReadInputSimplePublicObjectId(
+                properties=properties,
+                inputs=[SimplePublicObjectId(id=uid) for uid in ids],
+            ),
+            archived=False,
+            _request_timeout=self._timeout(timeout),
+        )
+
+    async def batch_read_async(self, object_type, ids, properties, timeout=None, priority=PRIORITY_CALL):
+        return await self._call_async(
+            self._api_limiter,
+            priority,
+            timeout,
+            '/crm/v3/objects/{}/batch/read'.format(object_type),
+            {'properties': properties, 'inputs': [{'id': uid} for uid in ids]},
+            params={'archived': 'false'},
+        )
+
+    def associations(self, from_type, to_type, ids, timeout=None, priority=PRIORITY_CALL):
+        """Return the ids of the `to_type` objects associated to each of the `from_type` objects of `ids`"""
+        response = self._call(
+            self._api_limiter,
+            priority,
+            timeout,
+            self._api(ASSOCIATIONS, 'batch_api').read,
+            from_object_type=from_type,
+            to_object_type=to_type,
+            batch_input_public_object_id=BatchInputPublicObjectId(
+                inputs=[PublicObjectId(id=uid) for uid in ids],
+            ),
+            _request_timeout=self._timeout(timeout),
+        )
+        return {result._from.id: [to.id for to in result.to] for result in response.results}
+
+    async def associations_async(self, from_type, to_type, ids, timeout=None, priority=PRIORITY_CALL):
+        return await self._call_async(
+            self._api_limiter,
+            priority,
+            timeout,
+            '/crm/v3/associations/{}/{}/batch/read'.format(from_type, to_type),
+            {'inputs': [{'id': uid} for uid in ids]},
+            parse=aio.parse_associations,
+        )
+
+    def rate_limit_stats(self):
+        return {
+            bucket: {'throttled': limiter.throttled, 'rejected': limiter.rejected}
+            for bucket, limiter in (('search', self._search_limiter), ('api', self._api_limiter))
+            if limiter is not None
+        }
+
+    def clear(self):
+        self._pool_manager.clear()
+        if self._transport is not None:
+            self._transport.close()
+
+    def _call(self, limiter, priority, timeout, method, **kwargs):
+        if limiter is not None and not limiter.acquire(priority, timeout):
+            raise RateLimitedError('Hubspot rate limit reached, request dropped')
+
+        try:
+            return method(**kwargs)
+        except API_ERRORS as e:
+            if e.status != 429:
+                raise
+            self._rate_limited(limiter, e)
+
+    async def _call_async(self, limiter, priority, timeout, path, body, params=None, parse=aio.parse_objects):
+        if limiter is not None and not await limiter.acquire_async(priority, timeout):
+            raise RateLimitedError('Hubspot rate limit reached, request dropped')
+
+        try:
+            payload = await self._transport.post(path, body, self._timeout(timeout), params=params)
+        except aio.TransportError as e:
+            if e.status != 429:
+                raise
+            self._rate_limited(limiter, e)
+        return parse(payload)
+
+    def _rate_limited(self, limiter, e):
+        retry_after = _retry_after(e)
+        logger.warning('Hubspot rate limit exceeded, pausing requests for %ss', retry_after)
+        if limiter is not None:
+            limiter.pause(retry_after)
+        raise RateLimitedError('Hubspot rate limit exceeded') from e
+
+    def _timeout(self, timeout):
+        connect_timeout, read_timeout = self._request_timeout
+        if timeout is None:
+            return self._request_timeout
+        return (min(connect_timeout, timeout), min(read_timeout, timeout))
+
+    def _api(self, object_type, name):
+        key = (object_type, name)
+        api = self._apis.get(key)
+        if api is not None:
+            return api
+
+        with self._lock:
+            if key not in self._apis:
+                discovery = {
+                    CONTACTS: self._hubspot.crm.contacts,
+                    COMPANIES: self._hubspot.crm.companies,
+                    ASSOCIATIONS: self._hubspot.crm.associations,
+                }[object_type]
+                api = getattr(discovery, name)
+                # Each generated API object owns a pool manager, swap it for the shared one
+                api.api_client.rest_client.pool_manager = self._pool_manager
+                api.api_client.configuration.host = self._api_url
+                self._apis[key] = api
+            return self._apis[key]
+
+
+def next_page(response):
+    """Return the cursor of the page following a response, or None"""
+    paging = getattr(response, 'paging', None)
+    if not paging or not paging.next:
+        return None
+    return paging.next.after
+
+
+def _retry_after(e):
+    try:
+        return float((e.headers or {}).get('Retry-After', DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def acquire_client(access_token, api_url, pool_config, rate_limit_config):
+    """Return the client shared by every source using the same token and configuration"""
+    key = (
+        access_token,
+        api_url,
+        tuple(sorted(pool_config.items())),
+        tuple(sorted(rate_limit_config.items())),
+    )
+    with _clients_lock:
+        client, count = _clients.get(key, (None, 0))
+        if client is None:
+            logger.info('Starting Hubspot client')
+            client = HubspotClient(access_token, api_url, pool_config, rate_limit_config)
+        _clients[key] = (client, count + 1)
+        return client
+
+
+def release_client(client):
+    with _clients_lock:
+        for key, (shared_client, count) in list(_clients.items()):
+            if shared_client is not client:
+                continue
+            if count > 1:
+                _clients[key] = (client, count - 1)
+            else:
+                del _clients[key]
+                client.clear()
+            return
@@ -1,11 +1,16 @@
 # Copyright 2023 École Hexagone (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import json
 
-from wazo_dird.auth import required_acl
+from flask import Response, request
+from wazo_dird.auth import get_tenant_uuids, required_acl
 from wazo_dird.helpers import SourceItem, SourceList
+from wazo_dird.http import AuthResource, ErrorCatchingResource
+from xivo.rest_api_helpers import APIException
 
-from .schemas import list_schema, source_schema, source_list_schema
+from . import registry
+from .schemas import list_schema, source_schema, source_list_schema, warm_schema
 
 
 class HubspotList(SourceList):
@@ -38,3 +43,82 @@ class HubspotItem(SourceItem):
     @required_acl('dird.backends.hubspot.sources.{source_uuid}.update')
     def put(self, source_uuid):
         return super().put(source_uuid)
+
+
+def _get_backend(source_uuid, tenant_uuids=None):
+    """Return the loaded backend of a source, visible from `tenant_uuids` when given"""
+    backend = registry.get_backend(source_uuid)
+    if backend is None or (tenant_uuids is not None and backend.tenant_uuid not in tenant_uuids):
+        raise APIException(404, 'No loaded Hubspot source', 'unknown-source', {'source_uuid': source_uuid})
+    return backend
+
+
+class HubspotMetrics(AuthResource):
+
+    @required_acl('dird.backends.hubspot.sources.{source_uuid}.metrics.read')
+    def get(self, source_uuid):
+        backend = _get_backend(source_uuid, get_tenant_uuids(recurse=True))
+        return Response(backend.metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class HubspotStats(AuthResource):
+
+    @required_acl('dird.backends.hubspot.sources.{source_uuid}.stats.read')
+    def get(self, source_uuid):
+        backend = _get_backend(source_uuid, get_tenant_uuids(recurse=True))
+        return backend.stats(), 200
+
+
+class HubspotCache(AuthResource):
+
+    @required_acl('dird.backends.hubspot.sources.{source_uuid}.cache.delete')
+    def delete(self, source_uuid):
+        backend = _get_backend(source_uuid, get_tenant_uuids(recurse=True))
+        backend.flush()
+        return '', 204
+
+
+class HubspotCacheWarm(AuthResource):
+
+    @required_acl('dird.backends.hubspot.sources.{source_uuid}.cache.warm.update')
+    def put(self, source_uuid):
+        backend = _get_backend(source_uuid, get_tenant_uuids(recurse=True))
+        body = warm_schema.load(request.get_json(force=True))
+        invalid = backend.warm(body['numbers'])
+        return {'invalid_numbers': invalid}, 202
+
+
+class HubspotMirrorResync(AuthResource):
+
+    @required_acl('dird.backends.hubspot.sources.{source_uuid}.mirror.resync.update')
+    def put(self, source_uuid):
+        backend = _get_backend(source_uuid, get_tenant_uuids(recurse=True))
+        if not backend.resync():
+            raise APIException(400, 'The mirror and number filter of this source are disabled', 'mirror-disabled', {})
+        return '', 202
+
+
+class HubspotWebhook(ErrorCatchingResource):
+    """
+    Hubspot cannot send a wazo-auth token: webhook requests are authenticated
+    by their signature instead.
+    """
+
+    def post(self, source_uuid):
+        backend = _get_backend(source_uuid)
+        if not backend.webhook_enabled:
+            raise APIException(404, 'No Hubspot webhook for source', 'unknown-source', {'source_uuid': source_uuid})
+
+        body = request.get_data()
+        if not backend.verify_webhook(request.method, request.url, body, request.headers):
+            raise APIException(401, 'Invalid Hubspot signature', 'invalid-signature', {'source_uuid': source_uuid})
+
+        try:
+            events = json.loads(body)
+        except ValueError:
+            events = None
+        if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+            raise APIException(400, 'Expected a list of Hubspot events', 'invalid-data', {})
+
+        backend.push_webhook_events(events)
+        return '', 204
@@ -0,0 +1,138 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import re
+import sys
+
+from bisect import bisect_left, insort
+
+from . import phone
+from .text import fold
+
+SEPARATORS = re.compile(r'[\W_]+')
+LETTERS = re.compile(r'[^\W\d_]')
+NON_DIGITS = re.compile(r'\D')
+
+# A search made only of digits must have at least this many, or it matches most numbers
+MIN_DIGITS = 3
+
+EXACT = 3
+PREFIX = 2
+SUFFIX = 1
+
+
+def tokenize(value):
+    return [token for token in SEPARATORS.split(fold(value)) if token]
+
+
+class SearchIndex:
+    """
+    Search index of the mirrored records.
+
+    Names are split into accent-folded tokens, kept sorted with their record
+    key so that the tokens starting with a prefix are found by binary search.
+    Phone numbers are kept as digits, dialed nationally and internationally,
+    in a sorted list and reversed in another one: a number is found by its
+    first digits ("0612") as well as by its last ones ("5678").
+
+    It is not thread safe, the `Mirror` owning it serializes the accesses.
+    """
+
+    def __init__(self):
+        self._tokens = []
+        self._digits = []
+        self._reversed_digits = []
+
+    @classmethod
+    def build(cls, entries):
+        """Return an index of `(key, tokens, numbers)` entries, sorted once"""
+        index = cls()
+        for key, tokens, numbers in entries:
+            index._tokens.extend((token, key) for token in set(tokens))
+            for digits in _digits(numbers):
+                index._digits.append((digits, key))
+                index._reversed_digits.append((digits[::-1], key))
+        index._tokens.sort()
+        index._digits.sort()
+        index._reversed_digits.sort()
+        return index
+
+    def add(self, key, tokens, numbers):
+        for token in set(tokens):
+            insort(self._tokens, (token, key))
+        for digits in _digits(numbers):
+            insort(self._digits, (digits, key))
+            insort(self._reversed_digits, (digits[::-1], key))
+
+    def remove(self, key, tokens, numbers):
+        for token in set(tokens):
+            _discard(self._tokens, (token, key))
+        for digits in _digits(numbers):
+            _discard(self._digits, (digits, key))
+            _discard(self._reversed_digits, (digits[::-1], key))
+
+    def search(self, term):
+        """
+        Return the keys of the records matching every word of `term` with
+        their score, higher is better. A term without letters is searched as
+        a phone number.
+        """
+        if LETTERS.search(term):
+            words = tokenize(term)
+        else:
+            digits = NON_DIGITS.sub('', term)
+            words = [digits] if len(digits) >= MIN_DIGITS else []
+
+        scores = None
+        for word in words:
+            matches = self._match_digits(word) if word.isdigit() else _match_prefix(self._tokens, word)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {key: score + matches[key] for key, score in scores.items() if key in matches}
+            if not scores:
+                return {}
+        return scores or {}
+
+    def __len__(self):
+        return len(self._tokens) + len(self._digits)
+
+    def memory(self, sample_size):
+        """Return the bytes used by the index, estimated on `sample_size` entries of each list"""
+        total = 0
+        for entries in (self._tokens, self._digits, self._reversed_digits):
+            total += sys.getsizeof(entries)
+            sample = entries[::max(1, len(entries) // sample_size)]
+            if sample:
+                # The keys are the ones of the mirror records, not counted here
+                size = sum(sys.getsizeof(entry) + sys.getsizeof(entry[0]) for entry in sample)
+                total += size * len(entries) // len(sample)
+        return total
+
+    def _match_digits(self, digits):
+        scores = _match_prefix(self._digits, digits)
+        for key, score in _match_prefix(self._reversed_digits, digits[::-1]).items():
+            scores[key] = max(scores.get(key, 0), SUFFIX if score == PREFIX else score)
+        return scores
+
+
+def _digits(numbers):
+    return {digits for number in numbers for digits in phone.digit_forms(number)}
+
+
+def _match_prefix(entries, prefix):
+    scores = {}
+    i = bisect_left(entries, (prefix,))
+    while i < len(entries) and entries[i][0].startswith(prefix):
+        value, key = entries[i]
+        score = EXACT if value == prefix else PREFIX
+        if scores.get(key, 0) < score:
+            scores[key] = score
+        i += 1
+    return scores
+
+
+def _discard(entries, entry):
+    i = bisect_left(entries, entry)
+    if i < len(entries) and entries[i] == entry:
+        del entries[i]
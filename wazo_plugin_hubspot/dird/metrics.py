@@ -0,0 +1,165 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from .ratelimit import RateLimitedError
+
+PREFIX = 'wazo_dird_hubspot_'
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+METRICS = {
+    'lookups_total': (COUNTER, 'Calls of search, first_match and list by result'),
+    'lookup_duration_seconds': (HISTOGRAM, 'Duration of search, first_match and list'),
+    'upstream_requests_total': (COUNTER, 'Requests sent to Hubspot by endpoint, object type and result'),
+    'upstream_request_duration_seconds': (HISTOGRAM, 'Duration of the requests sent to Hubspot'),
+    'upstream_timeouts_total': (COUNTER, 'Hubspot requests not answered before the source timeout'),
+    'upstream_skipped_total': (COUNTER, 'Hubspot requests not sent, the circuit breaker being open'),
+    'coalesced_requests_total': (COUNTER, 'Lookups that shared the Hubspot requests of a concurrent identical lookup'),
+    'cache_entries': (GAUGE, 'Entries in a cache'),
+    'cache_hits_total': (COUNTER, 'Cache hits'),
+    'cache_misses_total': (COUNTER, 'Cache misses, expired entries included'),
+    'cache_evictions_total': (COUNTER, 'Cache entries evicted to make room for new ones'),
+    'mirror_ready': (GAUGE, '1 when the mirror has been loaded'),
+    'mirror_records': (GAUGE, 'Records in the mirror'),
+    'mirror_record_bytes': (GAUGE, 'Average bytes used by a record of the mirror and its index entries, estimated'),
+    'search_index_entries': (GAUGE, 'Name tokens and phone digits in the search index of the mirror'),
+    'number_filter_numbers': (GAUGE, 'Phone numbers added to the filter of known numbers'),
+    'number_filter_bytes': (GAUGE, 'Memory used by the filter of known numbers'),
+    'number_filter_false_positive_rate': (GAUGE, 'Estimated share of unknown numbers still looked up in Hubspot'),
+    'circuit_breaker_open': (GAUGE, '1 when the circuit breaker is open or half-open'),
+    'circuit_breaker_opened_total': (COUNTER, 'Times the circuit breaker opened'),
+    'rate_limit_throttled_total': (COUNTER, 'Requests delayed by the client side rate limiter, by bucket'),
+    'rate_limit_rejected_total': (COUNTER, 'Requests dropped by the client side rate limiter, by bucket'),
+    'pool_checkouts_total': (COUNTER, 'Connections taken from the Hubspot connection pool'),
+    'pool_waits_total': (COUNTER, 'Connections waited for, the pool being exhausted'),
+    'pool_new_connections_total': (COUNTER, 'Connections opened to Hubspot'),
+    'webhook_events_total': (COUNTER, 'Webhook events received'),
+    'webhook_duplicate_events_total': (COUNTER, 'Webhook events already received'),
+}
+
+
+class _Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Lookup:
+
+    result = 'error'
+
+
+class Metrics:
+    """
+    Counters and duration histograms of a source, rendered in the Prometheus
+    text exposition format. Every metric must be declared in `METRICS`.
+    """
+
+    def __init__(self, **labels):
+        self._labels = labels
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(DURATION_BUCKETS)
+            histogram.observe(value)
+
+    @contextmanager
+    def lookup(self, operation):
+        """Time a lookup, and count it by the `result` set on the yielded object"""
+        lookup = _Lookup()
+        started_at = time.perf_counter()
+        try:
+            yield lookup
+        finally:
+            self.observe('lookup_duration_seconds', time.perf_counter() - started_at, operation=operation)
+            self.inc('lookups_total', operation=operation, result=lookup.result)
+
+    @contextmanager
+    def upstream(self, endpoint, object_type):
+        """Time a request sent to Hubspot, and count it by result"""
+        result = 'ok'
+        started_at = time.perf_counter()
+        try:
+            yield
+        except RateLimitedError as e:
+            # Either answered by a 429, or dropped by the client side rate limiter
+            result = '429' if e.__cause__ is not None else 'throttled'
+            raise
+        except Exception:
+            result = 'error'
+            raise
+        finally:
+            labels = {'endpoint': endpoint, 'object_type': object_type}
+            self.observe('upstream_request_duration_seconds', time.perf_counter() - started_at, **labels)
+            self.inc('upstream_requests_total', result=result, **labels)
+
+    def render(self, samples=()):
+        """
+        Return every metric as text, with the `(name, labels, value)` samples
+        given, which are read from the components of the source when scraped.
+        """
+        lines_by_name = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                lines_by_name.setdefault(name, []).append(self._line(name, dict(labels), value))
+            for (name, labels), histogram in self._histograms.items():
+                lines_by_name.setdefault(name, []).extend(self._histogram_lines(name, dict(labels), histogram))
+        for name, labels, value in samples:
+            lines_by_name.setdefault(name, []).append(self._line(name, labels, value))
+
+        lines = []
+        for name in sorted(lines_by_name):
+            metric_type, description = METRICS[name]
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, metric_type))
+            lines.extend(lines_by_name[name])
+        return '\n'.join(lines) + '\n'
+
+    def _histogram_lines(self, name, labels, histogram):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            yield self._line(name + '_bucket', dict(labels, le=repr(bound)), cumulative)
+        yield self._line(name + '_bucket', dict(labels, le='+Inf'), histogram.count)
+        yield self._line(name + '_sum', labels, histogram.sum)
+        yield self._line(name + '_count', labels, histogram.count)
+
+    def _line(self, name, labels, value):
+        labels = dict(self._labels, **labels)
+        rendered = ','.join('{}="{}"'.format(key, _escape(value)) for key, value in sorted(labels.items()))
+        return '{}{}{{{}}} {}'.format(PREFIX, name, rendered, float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
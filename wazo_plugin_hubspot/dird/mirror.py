@@ -0,0 +1,206 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import itertools
+import logging
+import sys
+import threading
+
+from .index import SearchIndex, tokenize
+
+logger = logging.getLogger(__name__)
+
+CONTACTS = 'contacts'
+COMPANIES = 'companies'
+
+
+class Mirror:
+    """
+    Local copy of Hubspot contacts and companies.
+
+    Records are keyed by `(object_type, uid)` and indexed by their normalized
+    phone numbers, so a reverse lookup is a dictionary access. They are stored
+    as returned by `prepare`, with their phone numbers already formatted, and
+    packed with the `RecordLayout` of their object type: a dict is only built
+    when a record is returned.
+
+    The values of `name_fields` and the phone numbers are also kept in a
+    `SearchIndex`, to answer directory searches.
+    """
+
+    MEMORY_SAMPLE_SIZE = 1000
+
+    def __init__(self, prepare, normalize, layouts, phone_fields, name_fields=None):
+        self._prepare = prepare
+        self._normalize = normalize
+        self._layouts = layouts
+        self._phone_fields = phone_fields
+        self._name_fields = name_fields or {}
+        self._records = {}
+        self._phone_index = {}
+        self._search_index = SearchIndex()
+        self._lock = threading.RLock()
+        self.ready = False
+
+    def upsert(self, object_type, uid, properties):
+        """Store a record, return its `(object_type, uid, properties, numbers)` item as stored"""
+        key = (object_type, uid)
+        properties = self._prepare(properties)
+        tokens, numbers = self._terms(key, properties)
+        record = self._layouts[object_type].pack(properties)
+        with self._lock:
+            self._unindex(key)
+            self._records[key] = record
+            self._index_numbers(self._phone_index, key, numbers)
+            self._search_index.add(key, tokens, numbers)
+        return object_type, uid, self._layouts[object_type].unpack(uid, record), numbers
+
+    def remove(self, object_type, uid):
+        key = (object_type, uid)
+        with self._lock:
+            self._unindex(key)
+            self._records.pop(key, None)
+
+    def replace(self, records):
+        """
+        Replace the whole content of the mirror with `(object_type, uid,
+        properties)` tuples, return an iterator over the items stored
+        """
+        latest = {(object_type, uid): properties for object_type, uid, properties in records}
+        new_records = {}
+        new_index = {}
+        entries = []
+        for key, properties in latest.items():
+            properties = self._prepare(properties)
+            tokens, numbers = self._terms(key, properties)
+            new_records[key] = self._layouts[key[0]].pack(properties)
+            self._index_numbers(new_index, key, numbers)
+            entries.append((key, tokens, numbers))
+        search_index = SearchIndex.build(entries)
+
+        with self._lock:
+            self._records = new_records
+            self._phone_index = new_index
+            self._search_index = search_index
+            self.ready = True
+        return self.items()
+
+    def get(self, object_type, uid):
+        record = self._records.get((object_type, uid))
+        if record is None:
+            return None
+        return self._layouts[object_type].unpack(uid, record)
+
+    def items(self):
+        with self._lock:
+            records = list(self._records.items())
+        for (object_type, uid), record in records:
+            properties = self._layouts[object_type].unpack(uid, record)
+            yield object_type, uid, properties, self.numbers(object_type, properties)
+
+    def lookup_number(self, number):
+        """Return `(object_type, properties)` of the first record using `number`, or None"""
+        with self._lock:
+            keys = self._phone_index.get(number)
+            if keys is None:
+                return None
+            key = keys[0] if isinstance(keys, list) else keys
+            return key[0], self._unpack(key)
+
+    def search(self, term, limit):
+        """Return `(object_type, properties)` of the best `limit` records matching `term`"""
+        with self._lock:
+            scores = self._search_index.search(term)
+            # Contacts first on equal scores, as in the live search
+            keys = sorted(scores, key=lambda key: (-scores[key], key[0] != CONTACTS, key))[:limit]
+            return [(key[0], self._unpack(key)) for key in keys]
+
+    def __len__(self):
+        return len(self._records)
+
+    def index_size(self):
+        return len(self._search_index)
+
+    def record_size(self):
+        """
+        Return the average bytes used by a record: its key, its packed
+        properties, and its share of the dicts, phone index and search index.
+        Estimated on a sample.
+        """
+        with self._lock:
+            count = len(self._records)
+            if not count:
+                return 0
+            sample = list(itertools.islice(self._records.items(), self.MEMORY_SAMPLE_SIZE))
+            numbers = list(itertools.islice(self._phone_index.items(), self.MEMORY_SAMPLE_SIZE))
+            total = sys.getsizeof(self._records) + sys.getsizeof(self._phone_index)
+            total += self._search_index.memory(self.MEMORY_SAMPLE_SIZE)
+            number_count = len(self._phone_index)
+
+        records = sum(
+            sys.getsizeof(key) + sys.getsizeof(key[1]) + self._layouts[key[0]].size(record) for key, record in sample
+        )
+        total += records * count // len(sample)
+        if numbers:
+            # The keys indexed are the ones of the records
+            index = sum(
+                sys.getsizeof(number) + (sys.getsizeof(keys) if isinstance(keys, list) else 0)
+                for number, keys in numbers
+            )
+            total += index * number_count // len(numbers)
+        return total // count
+
+    def _unpack(self, key):
+        return self._layouts[key[0]].unpack(key[1], self._records[key])
+
+    @staticmethod
+    def _index_numbers(index, key, numbers):
+        # A number is mostly used by a single record, stored alone to spare a list
+        for number in numbers:
+            keys = index.get(number)
+            if keys is None:
+                index[number] = key
+                continue
+            if not isinstance(keys, list):
+                keys = index[number] = [keys]
+            # Contacts take precedence over companies, as in the live lookup
+            if key[0] == CONTACTS:
+                keys.insert(0, key)
+            else:
+                keys.append(key)
+
+    def _unindex(self, key):
+        record = self._records.get(key)
+        if record is None:
+            return
+        properties = self._layouts[key[0]].unpack(key[1], record)
+        tokens, numbers = self._terms(key, properties)
+        self._search_index.remove(key, tokens, numbers)
+        for number in numbers:
+            keys = self._phone_index.get(number)
+            if keys == key:
+                del self._phone_index[number]
+            elif isinstance(keys, list) and key in keys:
+                keys.remove(key)
+                if len(keys) == 1:
+                    self._phone_index[number] = keys[0]
+
+    def _terms(self, key, properties):
+        tokens = [
+            token
+            for field in self._name_fields.get(key[0], [])
+            if properties.get(field)
+            for token in tokenize(properties[field])
+        ]
+        return tokens, self.numbers(key[0], properties)
+
+    def numbers(self, object_type, properties):
+        numbers = set()
+        for field in self._phone_fields[object_type]:
+            value = properties.get(field)
+            if not value:
+                continue
+            number = self._normalize(value)
+            if number:
+                numbers.add(number)
+        return numbers
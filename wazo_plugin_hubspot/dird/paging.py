@@ -0,0 +1,37 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from collections import deque
+
+
+def merge_pages(pages, fetch_next, key):
+    """
+    Yield `(object_type, record)` from the pages of results of several object
+    types, a page of each in turn.
+
+    `pages` maps each object type to its first `(records, after)` page. The
+    next page of an object type is only fetched, with
+    `fetch_next(object_type, after)`, when its turn comes, i.e. when the
+    consumer iterates past the records already fetched. `fetch_next` returns
+    None when the page could not be fetched. A record already yielded from a
+    previous page, as its `key` tells, is skipped.
+    """
+    seen = set()
+    queue = deque((object_type, records, after) for object_type, (records, after) in pages.items())
+    while queue:
+        object_type, records, after = queue.popleft()
+        if records is None:
+            page = fetch_next(object_type, after)
+            if page is None:
+                continue
+            records, after = page
+
+        for record in records:
+            record_key = (object_type, key(record))
+            if record_key in seen:
+                continue
+            seen.add(record_key)
+            yield object_type, record
+
+        if after is not None:
+            queue.append((object_type, None, after))
@@ -0,0 +1,93 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+
+from functools import lru_cache
+
+import phonenumbers
+
+from .text import fold
+
+logger = logging.getLogger(__name__)
+
+# Numbers parsed are memoized, the same customers keep calling back
+MEMO_SIZE = 65536
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _parse(number, region):
+    try:
+        parsed = phonenumbers.parse(number, region)
+    except phonenumbers.NumberParseException as e:
+        logger.debug('Exception when trying to parse phone number %s: %s', number, e)
+        return None
+    if not phonenumbers.is_possible_number(parsed):
+        # Internal extensions and short codes, e.g. "1234", are not phone numbers of Hubspot records
+        logger.debug('%s is not a possible phone number', number)
+        return None
+    return (
+        phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164),
+        phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.INTERNATIONAL),
+    )
+
+
+def to_e164(number, region=None):
+    """Return `number` in E.164 format, or None if it is not a possible phone number"""
+    formats = _parse(number, region)
+    return formats[0] if formats else None
+
+
+def to_international(number, region=None):
+    """Return `number` in international display format, or None if it is not a possible phone number"""
+    formats = _parse(number, region)
+    return formats[1] if formats else None
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def digit_forms(e164):
+    """
+    Return the digits of an E.164 number as dialed internationally and
+    nationally, "+33612345678" gives ("33612345678", "0612345678")
+    """
+    try:
+        parsed = phonenumbers.parse(e164)
+    except phonenumbers.NumberParseException:
+        return (e164.lstrip('+'),)
+    national = phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.NATIONAL)
+    return (e164.lstrip('+'), ''.join(c for c in national if c.isdigit()))
+
+
+@lru_cache(maxsize=None)
+def _country_names():
+    names = {}
+    try:
+        from phonenumbers.geodata.locale import LOCALE_DATA
+    except ImportError:
+        return names
+
+    for region, translations in LOCALE_DATA.items():
+        for name in translations.values():
+            names.setdefault(fold(name), region)
+    return names
+
+
+@lru_cache(maxsize=1024)
+def region_for_country(country, default=None):
+    """
+    Return the region code of a Hubspot `country` property, which is free text:
+    either a region code ("FR") or a country name in any language ("France").
+    """
+    if not country:
+        return default
+
+    code = country.strip().upper()
+    if code in phonenumbers.SUPPORTED_REGIONS:
+        return code
+
+    return _country_names().get(fold(country), default)
+
+
+def memo_info():
+    info = _parse.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
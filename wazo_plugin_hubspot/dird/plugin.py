@@ -2,29 +2,75 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import xmlrpc.client as xmlrpclib
+import asyncio
 import logging
+import os
+import re
+import sqlite3
+import threading
+import time
 
 from wazo_dird import BaseSourcePlugin, make_result_class
 from wazo_dird.helpers import BaseBackendView
 
-from . import http
+from . import http, phone, registry
+from .bloom import NumberFilter
+from .breaker import CircuitBreaker
+from .cache import MISS
+from .metrics import Metrics
+from .paging import merge_pages
+from .client import API_URL, UPSTREAM_ERRORS, acquire_client, next_page, release_client
+from .mirror import COMPANIES, CONTACTS, Mirror
+from .record import RecordLayout
+from .ratelimit import PRIORITY_BACKGROUND, PRIORITY_CALL, PRIORITY_UI, RateLimitedError
+from .shared_cache import create_cache
+from .singleflight import SingleFlight
+from .snapshot import Snapshot
+from .sync import MirrorSynchronizer
+from .warmup import CacheWarmer
+from .webhook import WebhookBatcher, verify_signature
 
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import partial
+from itertools import chain, islice
+from string import Formatter
 
-from hubspot import HubSpot
-from hubspot.crm.contacts import PublicObjectSearchRequest, ApiException
+from hubspot.crm.contacts import PublicObjectSearchRequest
 
-import phonenumbers
 
 logger = logging.getLogger(__name__)
 
 
+def _template_fields(template):
+    """Return the names of the fields used by a format column, "{firstname} {lastname}" gives both"""
+    return [
+        re.split(r'[.\[]', field_name, 1)[0]
+        for _, field_name, _, _ in Formatter().parse(template)
+        if field_name
+    ]
+
+
+def _association_tags(company_uid):
+    # Contacts are invalidated when their company is removed
+    return [company_uid] if company_uid else []
+
+
 class HubspotView(BaseBackendView):
 
     backend = 'hubspot'
     list_resource = http.HubspotList
     item_resource = http.HubspotItem
 
+    def load(self, dependencies):
+        super().load(dependencies)
+        api = dependencies['api']
+        api.add_resource(http.HubspotWebhook, '/backends/hubspot/sources/<source_uuid>/webhook')
+        api.add_resource(http.HubspotMetrics, '/backends/hubspot/sources/<source_uuid>/metrics')
+        api.add_resource(http.HubspotStats, '/backends/hubspot/sources/<source_uuid>/stats')
+        api.add_resource(http.HubspotCache, '/backends/hubspot/sources/<source_uuid>/cache')
+        api.add_resource(http.HubspotCacheWarm, '/backends/hubspot/sources/<source_uuid>/cache/warm')
+        api.add_resource(http.HubspotMirrorResync, '/backends/hubspot/sources/<source_uuid>/mirror/resync')
+
 
 class HubspotBackend(BaseSourcePlugin):
 
@@ -36,23 +82,43 @@ class HubspotBackend(BaseSourcePlugin):
     HUBSPOT_FIELD_MOBILE = 'mobilephone'
     HUBSPOT_FIELD_EMAIL = 'email'
     HUBSPOT_FIELD_COUNTRY = 'country'
+    HUBSPOT_FIELD_COMPANY_ID = 'associatedcompanyid'
 
-    HUBSPOT_CONTACT_FIELDS = [
+    # Always requested: the record id, and its country to parse national numbers
+    HUBSPOT_REQUIRED_FIELDS = [
         HUBSPOT_FIELD_ID,
-        HUBSPOT_FIELD_FIRSTNAME,
-        HUBSPOT_FIELD_LASTNAME,
-        HUBSPOT_FIELD_PHONE,
-        HUBSPOT_FIELD_MOBILE,
-        HUBSPOT_FIELD_EMAIL,
         HUBSPOT_FIELD_COUNTRY,
     ]
 
-    HUBSPOT_COMPANY_FIELDS = [
-        HUBSPOT_FIELD_ID,
-        HUBSPOT_FIELD_NAME,
-        HUBSPOT_FIELD_PHONE,
-        HUBSPOT_FIELD_COUNTRY,
-    ]
+    # Default properties searched by `search`
+    HUBSPOT_SEARCH_FIELDS = {
+        CONTACTS: [HUBSPOT_FIELD_FIRSTNAME, HUBSPOT_FIELD_LASTNAME, HUBSPOT_FIELD_PHONE, HUBSPOT_FIELD_MOBILE],
+        COMPANIES: [HUBSPOT_FIELD_NAME, HUBSPOT_FIELD_PHONE],
+    }
+
+    OBJECT_TYPE_TTL = 7 * 24 * 3600
+
+    STATE_DIR = '/var/lib/wazo-dird/hubspot'
+
+    # Tiers of first_match, the fastest first: lookup cache, unknown numbers filter, mirror, Hubspot
+    FIRST_MATCH_TIERS = ['cache', 'filter', 'mirror', 'live']
+
+    # Maximum number of inputs accepted by the batch read endpoints
+    BATCH_READ_SIZE = 100
+    COMPANY_FIELD_PREFIX = 'company_'
+
+    # Maximum page size of the search endpoints
+    WARMUP_SEARCH_LIMIT = 100
+    SEARCH_PAGE_SIZE = 100
+
+    # The search endpoints refuse to page past 10000 results
+    SEARCH_RESULTS_CAP = 10000
+
+    # Default phone properties matched by `first_match`
+    HUBSPOT_PHONE_FIELDS = {
+        CONTACTS: [HUBSPOT_FIELD_PHONE, HUBSPOT_FIELD_MOBILE],
+        COMPANIES: [HUBSPOT_FIELD_PHONE],
+    }
 
     def load(self, dependencies):
         """
@@ -62,9 +128,40 @@ class HubspotBackend(BaseSourcePlugin):
         config = dependencies['config']
 
         self.name = config['name']
+        self._source_uuid = config.get('uuid', self.name)
+        self.tenant_uuid = config.get('tenant_uuid')
+        self._metrics = Metrics(source=self.name)
+        self._default_region = config.get('default_region')
+        self._timeout = config.get('timeout', 3.0)
+        self._search_limit = config.get('search_limit', 10)
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.get('max_workers', 8),
+            thread_name_prefix='hubspot-{}'.format(self.name),
+        )
+        # Requests of live calls have their own workers, not to queue behind the ones waiting for a token
+        self._call_executor = ThreadPoolExecutor(
+            max_workers=config.get('max_workers', 8),
+            thread_name_prefix='hubspot-call-{}'.format(self.name),
+        )
+
+        # Concurrent identical lookups share the same Hubspot requests
+        self._inflight = SingleFlight()
 
-        logger.info('Starting Hubspot client')
-        self.api_client = HubSpot(access_token=config['access_token'])
+        breaker_config = config.get('circuit_breaker', {})
+        self._breaker = None
+        if breaker_config.get('enabled', True):
+            self._breaker = CircuitBreaker(
+                self.name,
+                failure_threshold=breaker_config.get('failure_threshold', 5),
+                cooldown=breaker_config.get('cooldown', 30),
+            )
+
+        self._client = acquire_client(
+            config['access_token'],
+            config.get('api_url', API_URL),
+            config.get('pool', {}),
+            config.get('rate_limit', {}),
+        )
 
         unique_column = self.HUBSPOT_FIELD_ID
 
@@ -84,6 +181,8 @@ class HubspotBackend(BaseSourcePlugin):
             )
 
 
+        self._load_properties(config, format_columns)
+
         self._SourceResult = make_result_class(
             'hubspot',
             self.name,
@@ -91,11 +190,531 @@ class HubspotBackend(BaseSourcePlugin):
             format_columns,
         )
 
+        cache_config = config.get('cache', {})
+        self._lookup_cache = None
+        if cache_config.get('enabled', True):
+            self._lookup_cache = self._create_cache(
+                cache_config,
+                'lookup',
+                ttl=cache_config.get('ttl', 900),
+                negative_ttl=cache_config.get('negative_ttl', 120),
+                tags=self._lookup_tags,
+            )
+
+        # Expired lookups are answered at once with the last known result, and refreshed in the background
+        self._serve_stale = cache_config.get('serve_stale', True)
+        self._refresher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hubspot-refresh-{}'.format(self.name))
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+        first_match_config = config.get('first_match', {})
+        self._first_match_tiers = first_match_config.get('tiers') or self.FIRST_MATCH_TIERS
+        self._first_match_deadline = first_match_config.get('deadline')
+        if self._first_match_deadline is None:
+            self._first_match_deadline = self._timeout
+        self._lookups = ThreadPoolExecutor(
+            max_workers=config.get('max_workers', 8),
+            thread_name_prefix='hubspot-lookup-{}'.format(self.name),
+        )
+
+        self._record_cache = None
+        if cache_config.get('enabled', True):
+            self._record_cache = self._create_cache(
+                cache_config,
+                'record',
+                ttl=cache_config.get('ttl', 900),
+                negative_ttl=0,
+            )
+
+        # Company associated to each contact, or None
+        self._associations = None
+        if self._company_fields and cache_config.get('enabled', True):
+            self._associations = self._create_cache(
+                cache_config,
+                'associations',
+                ttl=cache_config.get('ttl', 900),
+                negative_ttl=cache_config.get('negative_ttl', 120),
+                tags=_association_tags,
+            )
+
+        # Remembers whether a uid is a contact and whether it is a company, by `(object_type, uid)`
+        self._object_types = self._create_cache(
+            cache_config,
+            'object_types',
+            ttl=self.OBJECT_TYPE_TTL,
+            negative_ttl=0,
+        )
+
+        mirror_config = config.get('mirror', {})
+        self._mirror = None
+        self._synchronizer = None
+        self._snapshot = None
+        self._snapshot_ready = False
+        if mirror_config.get('enabled', False):
+            layouts = {
+                object_type: RecordLayout(fields, self.HUBSPOT_FIELD_ID, [self.HUBSPOT_FIELD_COUNTRY])
+                for object_type, fields in self._fields.items()
+            }
+            self._mirror = Mirror(
+                self._prepare_properties,
+                self._normalize_number,
+                layouts,
+                self._match_fields,
+                self._name_fields,
+            )
+            if mirror_config.get('snapshot', True):
+                self._snapshot, self._snapshot_ready = self._open_snapshot(
+                    mirror_config.get('state_dir', self.STATE_DIR), config.get('uuid', self.name), self._fields
+                )
+            self._synchronizer = MirrorSynchronizer(
+                self.name,
+                self._mirror,
+                self._client,
+                self._fields,
+                page_size=mirror_config.get('page_size', 100),
+                refresh_interval=mirror_config.get('refresh_interval', 300),
+                archived_interval=mirror_config.get('archived_interval', 3600),
+                snapshot=self._snapshot,
+            )
+            self._synchronizer.start()
+
+        # Without the mirror, a filter of the known numbers spares Hubspot the lookups of unknown callers
+        filter_config = config.get('number_filter', {})
+        self._number_filter = None
+        self._filter_synchronizer = None
+        self._filter_snapshot = None
+        if filter_config.get('enabled', False) and self._mirror is None:
+            self._number_filter = NumberFilter(
+                self._prepare_properties,
+                self._normalize_number,
+                self._match_fields,
+                false_positive_rate=filter_config.get('false_positive_rate', 0.01),
+                min_capacity=filter_config.get('min_capacity', 100000),
+            )
+            filter_fields = {
+                object_type: [self.HUBSPOT_FIELD_COUNTRY] + self._match_fields[object_type]
+                for object_type in (CONTACTS, COMPANIES)
+            }
+            if filter_config.get('snapshot', True):
+                # Shares the numbers pulled from Hubspot with the other wazo-dird processes
+                self._filter_snapshot, _ = self._open_snapshot(
+                    filter_config.get('state_dir', self.STATE_DIR),
+                    '{}.numbers'.format(config.get('uuid', self.name)),
+                    filter_fields,
+                )
+            self._filter_synchronizer = MirrorSynchronizer(
+                self.name,
+                self._number_filter,
+                self._client,
+                filter_fields,
+                page_size=filter_config.get('page_size', 100),
+                refresh_interval=filter_config.get('refresh_interval', 300),
+                # Removed records cannot be taken out of the filter, it is rebuilt instead
+                archived_interval=float('inf'),
+                snapshot=self._filter_snapshot,
+                full_sync_interval=filter_config.get('rebuild_interval', 86400),
+            )
+            self._filter_synchronizer.start()
+
+        webhook_config = config.get('webhook', {})
+        self._webhook_config = webhook_config
+        self._webhook = None
+        if webhook_config.get('client_secret'):
+            self._webhook = WebhookBatcher(
+                self.name,
+                self.apply_changes,
+                webhook_config.get('batch_interval', 2.0),
+                self._fields,
+            )
+            self._webhook.start()
+
+        warmup_config = config.get('warmup', {})
+        self._warmup_batch_size = warmup_config.get('batch_size', 50)
+        # Numbers pushed through the REST API, not to hold the refreshes of stale lookups
+        self._warmups = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hubspot-warmup-{}'.format(self.name))
+        self._warmups_stopped = threading.Event()
+        self._warmer = None
+        if warmup_config.get('enabled', False):
+            if self._lookup_cache is None or self._mirror is not None:
+                logger.info('Hubspot source %s has no lookup cache to warm up', self.name)
+            else:
+                self._warmer = CacheWarmer(
+                    self.name,
+                    self._warm_numbers,
+                    warmup_config.get('numbers', []),
+                    warmup_config.get('file'),
+                    warmup_config.get('interval', 0),
+                    warmup_config.get('max_numbers', 10000),
+                )
+                self._warmer.start()
+
+        registry.register(self._source_uuid, self)
+
+    def _load_properties(self, config, format_columns):
+        """
+        Work out the properties requested from Hubspot for each object type:
+        the ones displayed through `format_columns` and `first_matched_columns`,
+        the ones matched and searched (when searched locally), and the
+        additional ones of the `properties` option.
+        """
+        displayed = set()
+        for template in format_columns.values():
+            displayed.update(_template_fields(template))
+        for column in self._first_matched_columns:
+            displayed.update(_template_fields(format_columns[column]) if column in format_columns else [column])
+
+        # Fields of the company associated to a contact, "{company_name}" gives the company name
+        self._company_fields = []
+        if config.get('associations', {}).get('enabled', False):
+            company_fields = [field for field in displayed if field.startswith(self.COMPANY_FIELD_PREFIX)]
+            displayed.difference_update(company_fields)
+            self._company_fields = list(dict.fromkeys(
+                [self.HUBSPOT_FIELD_ID, self.HUBSPOT_FIELD_NAME]
+                + sorted(field[len(self.COMPANY_FIELD_PREFIX):] for field in company_fields)
+            ))
+
+        properties_config = config.get('properties', {})
+        searched_locally = config.get('mirror', {}).get('enabled', False)
+        self._fields = {}
+        self._search_fields = {}
+        self._match_fields = {}
+        self._name_fields = {}
+        for object_type in (CONTACTS, COMPANIES):
+            object_config = properties_config.get(object_type) or {}
+            self._search_fields[object_type] = object_config.get('search') or self.HUBSPOT_SEARCH_FIELDS[object_type]
+            self._match_fields[object_type] = object_config.get('match') or self.HUBSPOT_PHONE_FIELDS[object_type]
+            self._name_fields[object_type] = [
+                field for field in self._search_fields[object_type] if field not in self._match_fields[object_type]
+            ]
+
+            fields = self.HUBSPOT_REQUIRED_FIELDS + self._match_fields[object_type]
+            if searched_locally:
+                fields += self._search_fields[object_type]
+            fields += sorted(displayed) + object_config.get('extra', [])
+            if object_type == COMPANIES:
+                fields += self._company_fields
+            elif self._company_fields and searched_locally:
+                # The primary company of mirrored contacts is pulled with them, as a property
+                fields.append(self.HUBSPOT_FIELD_COMPANY_ID)
+            self._fields[object_type] = list(dict.fromkeys(fields))
+            logger.debug('Hubspot %s properties of source %s: %s', object_type, self.name, self._fields[object_type])
+
+        self._phone_fields = list(dict.fromkeys(chain.from_iterable(self._match_fields.values())))
+
+    def _create_cache(self, cache_config, name, ttl, negative_ttl, tags=None):
+        # Caches shared by several wazo-dird processes are namespaced by source
+        return create_cache(
+            cache_config,
+            '{}:{}'.format(self._source_uuid, name),
+            max_entries=cache_config.get('max_entries', 10000),
+            ttl=ttl,
+            negative_ttl=negative_ttl,
+            tags=tags,
+        )
+
+    def _lookup_tags(self, properties):
+        # Contacts are cached with the fields of their company, modifying either invalidates them
+        if properties is None:
+            return []
+        company_id_field = self.COMPANY_FIELD_PREFIX + self.HUBSPOT_FIELD_ID
+        uids = (properties.get(self.HUBSPOT_FIELD_ID), properties.get(company_id_field))
+        return [uid for uid in uids if uid]
+
     def unload(self):
         """
         The unload method is used to release any resources that are under the
         responsibility of this instance.
         """
+        registry.unregister(self._source_uuid, self)
+
+        if self._webhook is not None:
+            self._webhook.stop()
+
+        self._warmups_stopped.set()
+        if self._warmer is not None:
+            self._warmer.stop()
+
+        if self._synchronizer is not None:
+            self._synchronizer.stop()
+
+        if self._filter_synchronizer is not None:
+            self._filter_synchronizer.stop()
+
+        for snapshot in (self._snapshot, self._filter_snapshot):
+            if snapshot is not None:
+                snapshot.close()
+
+        for cache in (self._lookup_cache, self._record_cache, self._associations, self._object_types):
+            if cache is not None:
+                cache.close()
+
+        self._refresher.shutdown(wait=False)
+        self._warmups.shutdown(wait=False)
+        self._lookups.shutdown(wait=False)
+        self._executor.shutdown(wait=False)
+        self._call_executor.shutdown(wait=False)
+        logger.debug('Hubspot connection pool of source %s: %s', self.name, self._client.stats.as_dict())
+        release_client(self._client)
+
+    def stats(self):
+        return {
+            'pool': self._client.stats.as_dict(),
+            'rate_limit': self._client.rate_limit_stats(),
+            'coalesced_requests': self._inflight.shared,
+            'circuit_breaker': self._breaker.as_dict() if self._breaker is not None else None,
+            'phone_memo': phone.memo_info(),
+            'cache': {
+                'lookup': self._lookup_cache.as_dict() if self._lookup_cache is not None else None,
+                'record': self._record_cache.as_dict() if self._record_cache is not None else None,
+                'object_types': self._object_types.as_dict(),
+            },
+            'mirror': {
+                'enabled': self._mirror is not None,
+                'ready': self._mirror is not None and self._mirror.ready,
+                'records': len(self._mirror) if self._mirror is not None else 0,
+                'index_entries': self._mirror.index_size() if self._mirror is not None else 0,
+                'bytes_per_record': self._mirror.record_size() if self._mirror is not None else 0,
+                'snapshot': self._snapshot.path if self._snapshot is not None else None,
+                # Whether this process pulls the mirror from Hubspot, or follows the one that does
+                'leader': self._synchronizer is not None and self._synchronizer.leading,
+            },
+            'number_filter': self._number_filter_stats(),
+            'webhook': {
+                'enabled': self.webhook_enabled,
+                'received': self._webhook.received if self._webhook is not None else 0,
+                'duplicates': self._webhook.duplicates if self._webhook is not None else 0,
+            },
+        }
+
+    def _number_filter_stats(self):
+        if self._number_filter is None:
+            return None
+        stats = self._number_filter.as_dict()
+        stats['snapshot'] = self._filter_snapshot.path if self._filter_snapshot is not None else None
+        stats['leader'] = self._filter_synchronizer.leading
+        return stats
+
+    def flush(self):
+        """Forget every cached lookup and record, the mirror is kept"""
+        for cache in (self._lookup_cache, self._record_cache, self._associations, self._object_types):
+            if cache is not None:
+                cache.clear()
+        logger.info('Hubspot caches of source %s flushed', self.name)
+
+    def resync(self):
+        """
+        Start a full sync of the mirror, or a rebuild of the number filter,
+        return False when both are disabled
+        """
+        synchronizer = self._synchronizer or self._filter_synchronizer
+        if synchronizer is None:
+            return False
+        synchronizer.request_full_sync()
+        return True
+
+    def warm(self, numbers):
+        """
+        Look up `numbers` in the background, so that calls from them are
+        answered from the cache. Return the numbers that are not valid.
+        Nothing is looked up without a cache, or when the mirror answers.
+        """
+        invalid = [number for number in numbers if self._normalize_number(number) is None]
+        if self._lookup_cache is not None and self._mirror is None:
+            self._warmups.submit(self._warm_numbers, numbers, self._warmups_stopped)
+        return invalid
+
+    def _warm_numbers(self, numbers, stopped=None):
+        """Resolve the numbers not cached yet into the lookup cache, in batches"""
+        intnums = []
+        seen = set()
+        for number in numbers:
+            intnum = self._normalize_number(number)
+            if intnum and intnum not in seen and not self._lookup_cache.is_fresh(intnum):
+                seen.add(intnum)
+                intnums.append(intnum)
+
+        for i in range(0, len(intnums), self._warmup_batch_size):
+            if stopped is not None and stopped.is_set():
+                return
+            self._warm_batch(intnums[i:i + self._warmup_batch_size])
+
+    def _warm_batch(self, intnums):
+        """
+        Look up many numbers with a single search per object type, using the
+        IN operator, then cache the match of each number
+        """
+        requests = {
+            object_type: PublicObjectSearchRequest(
+                filter_groups=[
+                    {
+                        "filters": [
+                            {
+                                "values": intnums,
+                                "propertyName": phone_field,
+                                "operator": "IN"
+                            }
+                        ]
+                    }
+                    for phone_field in self._match_fields[object_type]
+                ],
+                properties=self._fields[object_type],
+                limit=self.WARMUP_SEARCH_LIMIT,
+            )
+            for object_type in (CONTACTS, COMPANIES)
+        }
+        results = self._search_all(requests, PRIORITY_BACKGROUND)
+        if results[CONTACTS] is None or results[COMPANIES] is None:
+            return
+
+        matches = {}
+        # Contacts take precedence over companies, as in first_match
+        for object_type, properties in reversed(self._with_companies(self._records_of(results), PRIORITY_BACKGROUND)):
+            for phone_field in self._match_fields[object_type]:
+                number = properties.get(phone_field) and self._normalize_number(properties[phone_field])
+                if number:
+                    matches[number] = properties
+
+        # With a full page, numbers without a match may be on the next one
+        complete = all(len(results[object_type]) < self.WARMUP_SEARCH_LIMIT for object_type in results)
+        for intnum in intnums:
+            if intnum in matches:
+                self._lookup_cache.set(intnum, matches[intnum])
+            elif complete:
+                self._lookup_cache.set(intnum, None)
+
+    def metrics(self):
+        """Return the metrics of the source in the Prometheus text format"""
+        samples = [
+            ('coalesced_requests_total', {}, self._inflight.shared),
+            ('mirror_ready', {}, int(self._mirror is not None and self._mirror.ready)),
+        ]
+        for cache_name, cache in (('lookup', self._lookup_cache), ('record', self._record_cache)):
+            if cache is None:
+                continue
+            labels = {'cache': cache_name}
+            samples += [
+                ('cache_entries', labels, len(cache)),
+                ('cache_hits_total', labels, cache.hits),
+                ('cache_misses_total', labels, cache.misses),
+                ('cache_evictions_total', labels, cache.evictions),
+            ]
+        if self._mirror is not None:
+            samples += [
+                ('mirror_records', {}, len(self._mirror)),
+                ('search_index_entries', {}, self._mirror.index_size()),
+                ('mirror_record_bytes', {}, self._mirror.record_size()),
+            ]
+        if self._number_filter is not None:
+            number_filter = self._number_filter.as_dict()
+            samples += [
+                ('number_filter_numbers', {}, number_filter['numbers']),
+                ('number_filter_bytes', {}, number_filter['bytes']),
+                ('number_filter_false_positive_rate', {}, number_filter['false_positive_rate']),
+            ]
+        if self._breaker is not None:
+            breaker = self._breaker.as_dict()
+            samples += [
+                ('circuit_breaker_open', {}, int(breaker['state'] != 'closed')),
+                ('circuit_breaker_opened_total', {}, breaker['opened']),
+            ]
+        for bucket, stats in self._client.rate_limit_stats().items():
+            samples += [
+                ('rate_limit_throttled_total', {'bucket': bucket}, stats['throttled']),
+                ('rate_limit_rejected_total', {'bucket': bucket}, stats['rejected']),
+            ]
+        pool = self._client.stats.as_dict()
+        samples += [
+            ('pool_checkouts_total', {}, pool['checkouts']),
+            ('pool_waits_total', {}, pool['waits']),
+            ('pool_new_connections_total', {}, pool['new_connections']),
+        ]
+        if self._webhook is not None:
+            samples += [
+                ('webhook_events_total', {}, self._webhook.received),
+                ('webhook_duplicate_events_total', {}, self._webhook.duplicates),
+            ]
+        return self._metrics.render(samples)
+
+    @property
+    def webhook_enabled(self):
+        return self._webhook is not None
+
+    def verify_webhook(self, method, url, body, headers):
+        return verify_signature(
+            self._webhook_config['client_secret'],
+            method,
+            self._webhook_config.get('url') or url,
+            body,
+            headers,
+            self._webhook_config.get('max_age', 300),
+        )
+
+    def push_webhook_events(self, events):
+        self._webhook.add(events)
+
+    def apply_changes(self, modified, deleted):
+        """
+        Read the objects modified in Hubspot and apply them, with the deleted
+        ones, to the mirror and the caches. `modified` and `deleted` are lists
+        of uids by object type.
+        """
+        upserts = []
+        unknown = []
+        for object_type, uids in modified.items():
+            for i in range(0, len(uids), self.BATCH_READ_SIZE):
+                chunk = uids[i:i + self.BATCH_READ_SIZE]
+                try:
+                    with self._metrics.upstream('batch_read', object_type):
+                        results = self._client.batch_read(
+                            object_type,
+                            chunk,
+                            self._fields[object_type],
+                            timeout=self._timeout,
+                            priority=PRIORITY_BACKGROUND,
+                        ).results
+                except UPSTREAM_ERRORS as e:
+                    # Forget them at least, the next sync will fetch them
+                    logger.error('Could not read Hubspot objects modified on source %s: %s', self.name, e)
+                    unknown.extend((object_type, uid) for uid in chunk)
+                    continue
+                upserts.extend((object_type, content.id, content.properties) for content in results)
+
+        removals = [(object_type, uid) for object_type, uids in deleted.items() for uid in uids]
+        if self._synchronizer is not None:
+            self._synchronizer.apply_changes(upserts, removals)
+        if self._filter_synchronizer is not None:
+            self._filter_synchronizer.apply_changes(upserts, removals)
+
+        self._invalidate(upserts, removals + unknown)
+
+    def _invalidate(self, upserts, removals):
+        keys = [(object_type, uid) for object_type, uid, _ in upserts] + removals
+        uids = {uid for _, uid in keys}
+
+        if self._lookup_cache is not None:
+            self._lookup_cache.invalidate_tagged(uids)
+            # Numbers now used by a record were maybe cached as unknown
+            for object_type, _, properties in upserts:
+                for field in self._match_fields[object_type]:
+                    number = properties.get(field) and self._normalize_number(properties[field])
+                    if number:
+                        self._lookup_cache.invalidate(number)
+
+        if self._record_cache is not None:
+            for key in keys:
+                self._record_cache.invalidate(key)
+        # A created object may have been remembered as missing
+        for key in keys:
+            self._object_types.invalidate(key)
+
+        if self._associations is not None:
+            # The company of a modified contact may have changed, a removed company is no one's anymore
+            for object_type, uid in keys:
+                if object_type == CONTACTS:
+                    self._associations.invalidate(uid)
+            removed_companies = {uid for object_type, uid in removals if object_type == COMPANIES}
+            if removed_companies:
+                self._associations.invalidate_tagged(removed_companies)
 
     def search(self, term, args=None):
         """
@@ -110,119 +729,76 @@ class HubspotBackend(BaseSourcePlugin):
         """
         logger.debug("search term=%s", term)
 
-        contact_public_object_search_request = PublicObjectSearchRequest(
-            filter_groups=[
-                {
-                    "filters": [
-                        {
-                            "value": "*" + term + "*",
-                            "propertyName": self.HUBSPOT_FIELD_FIRSTNAME,
-                            "operator": "CONTAINS_TOKEN"
-                        }
-                    ]
-                },
-                {
-                    "filters": [
-                        {
-                            "value": "*" + term + "*",
-                            "propertyName": self.HUBSPOT_FIELD_LASTNAME,
-                            "operator": "CONTAINS_TOKEN"
-                        }
-                    ]
-                },
-                {
-                    "filters": [
-                        {
-                            "value": "*" + term + "*",
-                            "propertyName": self.HUBSPOT_FIELD_PHONE,
-                            "operator": "CONTAINS_TOKEN"
-                        }
-                    ]
-                },
-                {
-                    "filters": [
-                        {
-                            "value": "*" + term + "*",
-                            "propertyName": self.HUBSPOT_FIELD_MOBILE,
-                            "operator": "CONTAINS_TOKEN"
-                        }
-                    ]
-                },
-                # {
-                #     "filters": [
-                #         {
-                #             "value": "*" + term + "*",
-                #             "propertyName": "hs_searchable_calculated_phone_number",
-                #             "operator": "CONTAINS_TOKEN"
-                #         }
-                #     ]
-                # },
-                # {
-                #     "filters": [
-                #         {
-                #             "value": "*" + term + "*",
-                #             "propertyName": "hs_searchable_calculated_mobile_number",
-                #             "operator": "CONTAINS_TOKEN"
-                #         }
-                #     ]
-                # },
-            ],
-            properties=self.HUBSPOT_CONTACT_FIELDS,
-            limit=10
-        )
+        offset, limit = self._paging(args)
+        with self._metrics.lookup('search') as lookup:
+            lookup.result, records = self._search(term, offset, limit)
+        return (self._SourceResult(properties) for properties in records)
 
-        company_public_object_search_request = PublicObjectSearchRequest(
-            filter_groups=[
-                {
-                    "filters": [
-                        {
-                            "value": "*" + term + "*",
-                            "propertyName": self.HUBSPOT_FIELD_NAME,
-                            "operator": "CONTAINS_TOKEN"
-                        }
-                    ]
-                },
-                {
-                    "filters": [
-                        {
-                            "value": "*" + term + "*",
-                            "propertyName": self.HUBSPOT_FIELD_PHONE,
-                            "operator": "CONTAINS_TOKEN"
-                        }
-                    ]
-                },
-                # {
-                #     "filters": [
-                #         {
-                #             "value": "*" + term + "*",
-                #             "propertyName": "hs_searchable_calculated_phone_number",
-                #             "operator": "CONTAINS_TOKEN"
-                #         }
-                #     ]
-                # },
-            ],
-            properties=self.HUBSPOT_COMPANY_FIELDS,
-            limit=10
+    def _paging(self, args):
+        """Return the offset and the limit (None when not paged) of the search arguments"""
+        args = args or {}
+        try:
+            offset = max(int(args.get('offset') or 0), 0)
+            limit = int(args['limit']) if args.get('limit') else None
+        except (TypeError, ValueError):
+            logger.debug('Ignoring invalid paging arguments %s', args)
+            return 0, None
+        return offset, limit
+
+    def _search(self, term, offset=0, limit=None):
+        """
+        Return the result of the search and an iterator over the matching
+        properties. Without a `limit`, only the first `search_limit` contacts
+        and companies are returned. Otherwise, results are paged from Hubspot
+        as they are consumed, up to `offset + limit`.
+        """
+        if self._mirror is not None and self._mirror.ready:
+            if limit is None:
+                offset, limit = 0, self._search_limit
+            records = self._mirror.search(term, offset + limit)[offset:]
+            return 'hit', (properties for _, properties in self._with_companies(records))
+
+        page_size = self._search_limit if limit is None else min(offset + limit, self.SEARCH_PAGE_SIZE)
+        do_search_page = self._do_search_page_async if self._client.is_async else self._do_search_page
+        pages = self._inflight.do(
+            ('search', term, page_size),
+            partial(self._call_all, {
+                object_type: partial(
+                    do_search_page, object_type, self._search_request(object_type, term, page_size), PRIORITY_UI
+                )
+                for object_type in (CONTACTS, COMPANIES)
+            }),
         )
 
-        try:
-            contacts_res = self.api_client.crm.contacts.search_api.do_search(
-                public_object_search_request=contact_public_object_search_request
+        failed = pages[CONTACTS] is None or pages[COMPANIES] is None
+        first_pages = {
+            object_type: (
+                self._page_with_companies(object_type, page[0]),
+                # Without a limit, only the first page is returned
+                page[1] if limit is not None else None,
             )
-        except ApiException as e:
-            logger.error("Exception when calling search_api->do_search: %s\n" % e)
+            for object_type, page in pages.items()
+            if page is not None
+        }
 
-        try:
-            companies_res = self.api_client.crm.companies.search_api.do_search(
-                public_object_search_request=company_public_object_search_request
-            )
-        except ApiException as e:
-            logger.error("Exception when calling search_api->do_search: %s\n" % e)
+        def fetch_next(object_type, after):
+            if int(after) >= self.SEARCH_RESULTS_CAP:
+                # The search API refuses to page past its cap
+                return None
+            request = self._search_request(object_type, term, page_size, after)
+            page = self._call_all({object_type: partial(do_search_page, object_type, request, PRIORITY_UI)})[object_type]
+            if page is None:
+                return None
+            return self._page_with_companies(object_type, page[0]), page[1]
 
-        return chain(
-            (self._source_result_from_content(contact) for contact in contacts_res.results),
-            (self._source_result_from_content(company) for company in companies_res.results),
-        )
+        merged = merge_pages(first_pages, fetch_next, key=lambda properties: properties[self.HUBSPOT_FIELD_ID])
+        records = (properties for _, properties in merged)
+        if limit is not None:
+            records = islice(records, offset, offset + limit)
+        return 'error' if failed else 'miss', records
+
+    def _page_with_companies(self, object_type, records):
+        return [properties for _, properties in self._with_companies([(object_type, p) for p in records])]
 
     def first_match(self, term, args=None):
         """
@@ -235,97 +811,158 @@ class HubspotBackend(BaseSourcePlugin):
         If the backend has a `unique_column` configuration, a new column will be
         added with a `__unique_id` header containing the unique key.
         """
-        intnum = phonenumbers.parse(term, None)
-        intnum = phonenumbers.format_number(intnum, phonenumbers.PhoneNumberFormat.E164)
+        with self._metrics.lookup('first_match') as lookup:
+            lookup.result, properties = self._first_match(term)
+        return self._SourceResult(properties) if properties is not None else None
+
+    def _first_match(self, term):
+        """
+        Return the result of the lookup (hit, stale, miss...) and the matched
+        properties, from the first of the configured tiers that can answer.
 
-        contact_public_object_search_request = PublicObjectSearchRequest(
+        Every tier is bounded by the deadline of the lookup: the cache, the
+        filter and the mirror are read locally, the companies of a mirrored
+        contact are only read from Hubspot while time remains, and the live
+        tier stops waiting for Hubspot at the deadline.
+        """
+        intnum = self._normalize_number(term)
+        if intnum is None:
+            logger.debug('first_match: "%s" is not a valid phone number', term)
+            return 'invalid', None
+
+        deadline = time.monotonic() + self._first_match_deadline
+        for tier in self._first_match_tiers:
+            answer = getattr(self, '_first_match_{}'.format(tier))(intnum, deadline)
+            if answer is not None:
+                return answer
+        return 'miss', None
+
+    def _first_match_cache(self, intnum, deadline):
+        if self._lookup_cache is None:
+            return None
+        cached = self._lookup_cache.get(intnum)
+        if cached is not MISS:
+            logger.debug('first_match cache hit for %s', intnum)
+            return 'hit', cached
+
+    def _first_match_filter(self, intnum, deadline):
+        if self._number_filter is not None and self._number_filter.ready and intnum not in self._number_filter:
+            logger.debug('first_match: %s is not a Hubspot number', intnum)
+            return 'filtered', None
+
+    def _first_match_mirror(self, intnum, deadline):
+        if self._mirror is not None and self._mirror.ready:
+            match = self._mirror.lookup_number(intnum)
+        elif self._snapshot is not None and self._snapshot_ready:
+            # The mirror is still being loaded, the snapshot it is loaded from can answer
+            match = self._lookup_snapshot(intnum)
+            if match is MISS:
+                return None
+        else:
+            return None
+
+        if match is None:
+            return 'hit', None
+        return 'hit', self._with_companies([match], PRIORITY_CALL, deadline)[0][1]
+
+    def _first_match_live(self, intnum, deadline):
+        stale = self._lookup_cache.get_stale(intnum) if self._lookup_cache is not None else MISS
+        if stale is not MISS and self._serve_stale:
+            logger.debug('first_match stale hit for %s, refreshing it', intnum)
+            self._revalidate(intnum)
+            return 'stale', stale
+
+        # Past the deadline, the lookup goes on in the background and fills the cache
+        future = self._lookups.submit(
+            self._inflight.do,
+            ('first_match', intnum),
+            partial(self._fetch_first_match, intnum),
+        )
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except TimeoutError:
+            logger.info('first_match of %s on source %s past its deadline', intnum, self.name)
+            if stale is not MISS:
+                return 'stale', stale
+            return 'timeout', None
+
+    def _search_request(self, object_type, term, limit=None, after=None):
+        return PublicObjectSearchRequest(
             filter_groups=[
                 {
                     "filters": [
                         {
-                            "value": intnum,
-                            "propertyName": self.HUBSPOT_FIELD_PHONE,
-                            "operator": "EQ"
-                        }
-                    ]
-                },
-                {
-                    "filters": [
-                        {
-                            "value": intnum,
-                            "propertyName": self.HUBSPOT_FIELD_MOBILE,
-                            "operator": "EQ"
+                            "value": "*" + term + "*",
+                            "propertyName": field,
+                            "operator": "CONTAINS_TOKEN"
                         }
                     ]
-                },
-                # {
-                #     "filters": [
-                #         {
-                #             "value": intnum,
-                #             "propertyName": "hs_searchable_calculated_phone_number",
-                #             "operator": "EQ"
-                #         }
-                #     ]
-                # },
-                # {
-                #     "filters": [
-                #         {
-                #             "value": intnum,
-                #             "propertyName": "hs_searchable_calculated_mobile_number",
-                #             "operator": "EQ"
-                #         },
-                #     ]
-                # },
+                }
+                for field in self._search_fields[object_type]
             ],
-            properties=self.HUBSPOT_CONTACT_FIELDS,
-            limit=1
+            properties=self._fields[object_type],
+            limit=limit or self._search_limit,
+            after=after,
         )
 
-        company_public_object_search_request = PublicObjectSearchRequest(
+    def _match_request(self, object_type, intnum):
+        return PublicObjectSearchRequest(
             filter_groups=[
                 {
                     "filters": [
                         {
                             "value": intnum,
-                            "propertyName": self.HUBSPOT_FIELD_PHONE,
+                            "propertyName": field,
                             "operator": "EQ"
                         }
                     ]
-                },
-                # {
-                #     "filters": [
-                #         {
-                #             "value": intnum,
-                #             "propertyName": "hs_searchable_calculated_phone_number",
-                #             "operator": "EQ"
-                #         }
-                #     ]
-                # },
+                }
+                for field in self._match_fields[object_type]
             ],
-            properties=self.HUBSPOT_COMPANY_FIELDS,
+            properties=self._fields[object_type],
             limit=1
         )
 
-        try:
-            contacts_res =  self.api_client.crm.contacts.search_api.do_search(
-                public_object_search_request=contact_public_object_search_request
-            )
-        except ApiException as e:
-            logger.error("Exception when calling search_api->do_search: %s\n" % e)
+    def _revalidate(self, intnum):
+        with self._refreshing_lock:
+            if intnum in self._refreshing:
+                return
+            self._refreshing.add(intnum)
+        self._refresher.submit(self._refresh_first_match, intnum)
 
+    def _refresh_first_match(self, intnum):
         try:
-            companies_res =  self.api_client.crm.companies.search_api.do_search(
-                public_object_search_request=company_public_object_search_request
+            self._inflight.do(
+                ('first_match', intnum),
+                partial(self._fetch_first_match, intnum, PRIORITY_BACKGROUND),
             )
-        except ApiException as e:
-            logger.error("Exception when calling search_api->do_search: %s\n" % e)
-        
-        results = chain(
-            (self._source_result_from_content(contact) for contact in contacts_res.results),
-            (self._source_result_from_content(company) for company in companies_res.results),
-        )
+        except Exception:
+            logger.exception('Could not refresh the lookup of %s on source %s', intnum, self.name)
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(intnum)
+
+    def _fetch_first_match(self, intnum, priority=PRIORITY_CALL):
+        results = self._search_all({
+            object_type: self._match_request(object_type, intnum) for object_type in (CONTACTS, COMPANIES)
+        }, priority)
+
+        match = self._records_of(results)[:1]
+        properties = self._with_companies(match, priority)[0][1] if match else None
+
+        complete = results[CONTACTS] is not None and results[COMPANIES] is not None
+        result = 'miss' if complete or results[CONTACTS] else 'error'
+        if self._lookup_cache is not None:
+            if result == 'miss':
+                self._lookup_cache.set(intnum, properties)
+            elif properties is None:
+                # Hubspot could not answer, use the last known result instead
+                stale = self._lookup_cache.get_stale(intnum)
+                if stale is not MISS:
+                    logger.info('Hubspot unavailable, using last known result for %s', intnum)
+                    result, properties = 'stale', stale
 
-        return results[0] if 0 < len(results) else None
+        return result, properties
 
     def list(self, uids, args):
         """
@@ -337,64 +974,328 @@ class HubspotBackend(BaseSourcePlugin):
         results from search. Meaning that the `__unique_id` column should be
         added and display columns should be present.
         """
-        
-        contact_public_object_search_request = PublicObjectSearchRequest(
-            filter_groups=[
-                {
-                    "filters": [
-                        {
-                            "values": uids,
-                            "propertyName": self.HUBSPOT_FIELD_ID,
-                            "operator": "IN"
-                        }
-                    ]
-                },
-            ],
-            properties=self.HUBSPOT_CONTACT_FIELDS,
+        with self._metrics.lookup('list') as lookup:
+            lookup.result, records = self._list(uids)
+        return (
+            self._SourceResult(records[(object_type, uid)])
+            for uid in uids
+            for object_type in (CONTACTS, COMPANIES)
+            if (object_type, uid) in records
         )
 
-        company_public_object_search_request = PublicObjectSearchRequest(
-            filter_groups=[
-                {
-                    "filters": [
-                        {
-                            "values": uids,
-                            "propertyName": self.HUBSPOT_FIELD_ID,
-                            "operator": "IN"
-                        }
-                    ]
-                },
-            ],
-            properties=self.HUBSPOT_COMPANY_FIELDS,
-        )
+    def _list(self, uids):
+        """Return the result of the lookup and the properties of the records found by `(object_type, uid)`"""
+        records = {}
+        to_fetch = {CONTACTS: [], COMPANIES: []}
+        for uid in uids:
+            # A uid can be a contact, a company, or both with the same id
+            for object_type in (CONTACTS, COMPANIES):
+                if self._object_types.get((object_type, uid)) is False:
+                    continue
+                properties = self._known_record(object_type, uid)
+                if properties is not None:
+                    records[(object_type, uid)] = properties
+                else:
+                    to_fetch[object_type].append(uid)
 
-        try:
-            contacts_res =  self.api_client.crm.contacts.search_api.do_search(
-                public_object_search_request=contact_public_object_search_request
+        do_batch_read = self._do_batch_read_async if self._client.is_async else self._do_batch_read
+        calls = {}
+        for object_type, ids in to_fetch.items():
+            for i in range(0, len(ids), self.BATCH_READ_SIZE):
+                chunk = ids[i:i + self.BATCH_READ_SIZE]
+                calls[(object_type, i)] = partial(do_batch_read, object_type, chunk)
+
+        failed = set()
+        for (object_type, i), results in self._call_all(calls).items():
+            if results is None:
+                failed.add(object_type)
+                continue
+            for properties in results:
+                records[(object_type, properties[self.HUBSPOT_FIELD_ID])] = properties
+            for uid in to_fetch[object_type][i:i + self.BATCH_READ_SIZE]:
+                if (object_type, uid) not in records:
+                    # Not read again as this object type until it is created
+                    self._object_types.set((object_type, uid), False)
+
+        if failed and self._record_cache is not None:
+            # Hubspot could not answer, use the last known records instead
+            for object_type in failed:
+                for uid in to_fetch[object_type]:
+                    stale = self._record_cache.get_stale((object_type, uid))
+                    if (object_type, uid) not in records and stale is not MISS:
+                        records[(object_type, uid)] = stale
+
+        keys = list(records)
+        with_companies = self._with_companies([(object_type, records[(object_type, uid)]) for object_type, uid in keys])
+        records = dict(zip(keys, (properties for _, properties in with_companies)))
+        if failed:
+            return 'error', records
+        return 'miss' if calls else 'hit', records
+
+    def _known_record(self, object_type, uid):
+        if self._mirror is not None and self._mirror.ready:
+            return self._mirror.get(object_type, uid)
+
+        if self._record_cache is not None:
+            properties = self._record_cache.get((object_type, uid))
+            if properties is not MISS:
+                return properties
+
+    def _records_of(self, results):
+        """Return `(object_type, properties)` of search results by object type, contacts first"""
+        return [
+            (object_type, properties)
+            for object_type in (CONTACTS, COMPANIES)
+            for properties in results[object_type] or []
+        ]
+
+    def _with_companies(self, records, priority=PRIORITY_UI, deadline=None):
+        """
+        Add the `company_*` fields of their associated company to the contacts
+        of `(object_type, properties)` records. The associations and companies
+        of every contact are read at once, from the mirror, the caches or with
+        one batch request each. Past the `deadline`, the company fields not
+        known locally are left empty.
+        """
+        if not self._company_fields:
+            return records
+
+        contacts = [properties[self.HUBSPOT_FIELD_ID] for object_type, properties in records if object_type == CONTACTS]
+        companies = self._companies_of(contacts, priority, deadline) if contacts else {}
+        return [
+            (object_type, self._add_company(properties, companies.get(properties[self.HUBSPOT_FIELD_ID])))
+            if object_type == CONTACTS else (object_type, properties)
+            for object_type, properties in records
+        ]
+
+    def _add_company(self, properties, company):
+        properties = dict(properties)
+        for field in self._company_fields:
+            properties[self.COMPANY_FIELD_PREFIX + field] = company.get(field) if company is not None else None
+        return properties
+
+    def _companies_of(self, contact_uids, priority, deadline=None):
+        """Return the properties of the company associated to each contact having one"""
+        company_uids = {}
+        unknown = []
+        for uid in dict.fromkeys(contact_uids):
+            company_uid = self._company_uid(uid)
+            if company_uid is MISS:
+                unknown.append(uid)
+            elif company_uid is not None:
+                company_uids[uid] = company_uid
+
+        do_associations = self._do_associations_async if self._client.is_async else self._do_associations
+        calls = {
+            ('associations', i): partial(do_associations, unknown[i:i + self.BATCH_READ_SIZE], priority)
+            for i in range(0, len(unknown), self.BATCH_READ_SIZE)
+        }
+        for (_, i), associations in self._call_all(calls, priority, deadline).items():
+            if associations is None:
+                continue
+            for uid in unknown[i:i + self.BATCH_READ_SIZE]:
+                # The first associated company is the primary one
+                company_uid = next(iter(associations.get(uid) or []), None)
+                if self._associations is not None:
+                    self._associations.set(uid, company_uid)
+                if company_uid is not None:
+                    company_uids[uid] = company_uid
+
+        companies = {}
+        for company_uid in set(company_uids.values()):
+            properties = self._known_record(COMPANIES, company_uid)
+            if properties is not None:
+                companies[company_uid] = properties
+        to_fetch = [company_uid for company_uid in set(company_uids.values()) if company_uid not in companies]
+
+        do_batch_read = self._do_batch_read_async if self._client.is_async else self._do_batch_read
+        calls = {
+            (COMPANIES, i): partial(do_batch_read, COMPANIES, to_fetch[i:i + self.BATCH_READ_SIZE], priority)
+            for i in range(0, len(to_fetch), self.BATCH_READ_SIZE)
+        }
+        for results in self._call_all(calls, priority, deadline).values():
+            for properties in results or []:
+                companies[properties[self.HUBSPOT_FIELD_ID]] = properties
+
+        return {uid: companies[company_uid] for uid, company_uid in company_uids.items() if company_uid in companies}
+
+    def _company_uid(self, contact_uid):
+        """Return the uid of the company of a contact, None when it has none, or MISS when it is not known"""
+        if self._mirror is not None and self._mirror.ready:
+            properties = self._mirror.get(CONTACTS, contact_uid)
+            if properties is not None:
+                return properties.get(self.HUBSPOT_FIELD_COMPANY_ID) or None
+        if self._associations is not None:
+            return self._associations.get(contact_uid)
+        return MISS
+
+    def _remember(self, object_type, uid, properties):
+        self._object_types.set((object_type, uid), True)
+        if self._record_cache is not None:
+            self._record_cache.set((object_type, uid), properties)
+
+    def _search_all(self, requests, priority):
+        """
+        Send the search requests of each object type concurrently. The results
+        of a request that failed or did not answer in time are None.
+        """
+        do_search = self._do_search_async if self._client.is_async else self._do_search
+        return self._call_all({
+            object_type: partial(do_search, object_type, request, priority)
+            for object_type, request in requests.items()
+        }, priority)
+
+    def _call_all(self, calls, priority=PRIORITY_UI, deadline=None):
+        """
+        Send the calls concurrently, on the workers of their priority, and
+        return their results by key. The result of a call that failed or did
+        not answer in time, within the timeout or before the `deadline`
+        (a `time.monotonic` value) when earlier, is None.
+        """
+        if not calls:
+            return {}
+
+        timeout_at = time.monotonic() + self._timeout
+        if deadline is not None and deadline < timeout_at:
+            timeout_at = deadline
+            if timeout_at <= time.monotonic():
+                logger.debug('Hubspot requests %s of source %s past their deadline', list(calls), self.name)
+                return {key: None for key in calls}
+        if self._breaker is not None and not self._breaker.allow():
+            logger.debug('Hubspot circuit breaker open on source %s, skipping %s', self.name, list(calls))
+            self._metrics.inc('upstream_skipped_total', len(calls))
+            return {key: None for key in calls}
+
+        futures = {key: self._submit(call, priority) for key, call in calls.items()}
+        if self._breaker is not None:
+            # Requests that time out here still complete in the background, and tell whether Hubspot answered
+            for future in futures.values():
+                future.add_done_callback(self._record_outcome)
+
+        results = {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result(timeout=max(0, timeout_at - time.monotonic()))
+            except TimeoutError:
+                logger.warning('Hubspot request %s timed out on source %s', key, self.name)
+                # A request still waiting for a worker is dropped. Coroutines end on their own timeouts
+                # instead, so that a request already sent reports whether Hubspot answered.
+                if not asyncio.iscoroutinefunction(calls[key].func):
+                    future.cancel()
+                self._metrics.inc('upstream_timeouts_total')
+                results[key] = None
+            except UPSTREAM_ERRORS as e:
+                logger.error("Exception when calling Hubspot API: %s\n" % e)
+                results[key] = None
+        return results
+
+    def _record_outcome(self, future):
+        """
+        Feed the circuit breaker with the outcome of a Hubspot request. Only
+        errors from Hubspot count as failures: requests cancelled or dropped
+        by the client side rate limiter never reached it.
+        """
+        if future.cancelled():
+            self._breaker.record_ignored()
+            return
+
+        error = future.exception()
+        throttled = isinstance(error, RateLimitedError) and error.__cause__ is None
+        if error is None:
+            self._breaker.record_success()
+        elif isinstance(error, UPSTREAM_ERRORS) and not throttled:
+            self._breaker.record_failure()
+        else:
+            self._breaker.record_ignored()
+
+    def _submit(self, call, priority):
+        # Coroutines share the event loop of the async transport instead of holding a thread each
+        if asyncio.iscoroutinefunction(call.func):
+            return self._client.submit(call())
+        executor = self._call_executor if priority == PRIORITY_CALL else self._executor
+        return executor.submit(call)
+
+    def _do_search(self, object_type, request, priority):
+        return self._do_search_page(object_type, request, priority)[0]
+
+    def _do_search_page(self, object_type, request, priority):
+        """Return the results of a search request and the cursor of the next page, or None"""
+        with self._metrics.upstream('search', object_type):
+            response = self._client.search(object_type, request, timeout=self._timeout, priority=priority)
+        return [self._prepare_content(object_type, content) for content in response.results], next_page(response)
+
+    def _do_batch_read(self, object_type, uids, priority=PRIORITY_UI):
+        with self._metrics.upstream('batch_read', object_type):
+            results = self._client.batch_read(
+                object_type, uids, self._fields[object_type], timeout=self._timeout, priority=priority
+            ).results
+        return [self._prepare_content(object_type, content) for content in results]
+
+    async def _do_search_async(self, object_type, request, priority):
+        return (await self._do_search_page_async(object_type, request, priority))[0]
+
+    async def _do_search_page_async(self, object_type, request, priority):
+        with self._metrics.upstream('search', object_type):
+            response = await self._client.search_async(
+                object_type, request, timeout=self._timeout, priority=priority
             )
-        except ApiException as e:
-            logger.error("Exception when calling search_api->do_search: %s\n" % e)
+        return [self._prepare_content(object_type, content) for content in response.results], next_page(response)
 
-        try:
-            companies_res =  self.api_client.crm.companies.search_api.do_search(
-                public_object_search_request=company_public_object_search_request
+    async def _do_batch_read_async(self, object_type, uids, priority=PRIORITY_UI):
+        with self._metrics.upstream('batch_read', object_type):
+            response = await self._client.batch_read_async(
+                object_type, uids, self._fields[object_type], timeout=self._timeout, priority=priority
+            )
+        return [self._prepare_content(object_type, content) for content in response.results]
+
+    def _do_associations(self, uids, priority):
+        with self._metrics.upstream('associations', CONTACTS):
+            return self._client.associations(CONTACTS, COMPANIES, uids, timeout=self._timeout, priority=priority)
+
+    async def _do_associations_async(self, uids, priority):
+        with self._metrics.upstream('associations', CONTACTS):
+            return await self._client.associations_async(
+                CONTACTS, COMPANIES, uids, timeout=self._timeout, priority=priority
             )
-        except ApiException as e:
-            logger.error("Exception when calling search_api->do_search: %s\n" % e)
-        
-        return chain(
-            (self._source_result_from_content(contact) for contact in contacts_res.results), 
-            (self._source_result_from_content(company) for company in companies_res.results),
-        )
 
-    def _source_result_from_content(self, content):
+    def _open_snapshot(self, state_dir, name, properties):
+        """Return the snapshot, or None, and whether it holds `properties` already"""
+        path = os.path.join(state_dir, '{}.sqlite'.format(name))
         try:
-            for phone_property in [self.HUBSPOT_FIELD_PHONE, self.HUBSPOT_FIELD_MOBILE]:
-                if phone_property in content.properties and content.properties[phone_property]:
-                    parsed_phone = phonenumbers.parse(content.properties[phone_property], None)
-                    content.properties[phone_property] = phonenumbers.format_number(parsed_phone, phonenumbers.PhoneNumberFormat.INTERNATIONAL)
-            
-        except phonenumbers.NumberParseException as e:
-            logger.warn("Exception when trying to parse phone number: %s\n" % e)
-
-        return self._SourceResult(content.properties)
+            snapshot = Snapshot(path)
+            # A snapshot of other properties cannot answer until the mirror is pulled again
+            ready = bool(snapshot.watermarks()) and snapshot.properties() == properties
+        except (OSError, sqlite3.Error) as e:
+            logger.error('Could not open Hubspot snapshot %s: %s', path, e)
+            return None, False
+        return snapshot, ready
+
+    def _lookup_snapshot(self, number):
+        try:
+            return self._snapshot.lookup_number(number)
+        except sqlite3.Error as e:
+            logger.error('Could not read Hubspot snapshot of source %s: %s', self.name, e)
+            return MISS
+
+    def _prepare_content(self, object_type, content):
+        properties = self._prepare_properties(content.properties)
+        properties.setdefault(self.HUBSPOT_FIELD_ID, content.id)
+        self._remember(object_type, content.id, properties)
+        return properties
+
+    def _prepare_properties(self, properties):
+        """
+        Return a copy of `properties` with phone numbers in display format. The
+        record's country is used to parse numbers in national format.
+        """
+        properties = dict(properties)
+        region = phone.region_for_country(properties.get(self.HUBSPOT_FIELD_COUNTRY), self._default_region)
+        for phone_property in self._phone_fields:
+            if properties.get(phone_property):
+                number = phone.to_international(properties[phone_property], region)
+                if number:
+                    properties[phone_property] = number
+        return properties
+
+    def _normalize_number(self, number):
+        return phone.to_e164(number, self._default_region)
@@ -0,0 +1,127 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Lower values go first: live calls are served before the directory UI,
+# which is served before background synchronization
+PRIORITY_CALL = 0
+PRIORITY_UI = 1
+PRIORITY_BACKGROUND = 2
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    Token bucket refilled at `rate` tokens per second, up to `rate` tokens.
+
+    A request of priority `p` is only granted when `p * reserve` tokens would
+    remain afterwards, so that lower priority requests cannot starve the
+    higher priority ones. `pause` empties the bucket until a given delay has
+    elapsed, to honour the `Retry-After` of a 429 response.
+    """
+
+    def __init__(self, rate, reserve, clock=time.monotonic):
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._rate = rate
+        self._reserve = reserve
+        self._tokens = float(rate)
+        self._updated_at = clock()
+        self._paused_until = 0
+
+        self.throttled = 0
+        self.rejected = 0
+
+    def configure(self, rate, reserve):
+        with self._condition:
+            self._rate = rate
+            self._reserve = reserve
+
+    def acquire(self, priority=PRIORITY_CALL, timeout=None):
+        deadline = None if timeout is None else self._clock() + timeout
+        throttled = False
+        with self._condition:
+            while True:
+                now = self._clock()
+                wait = self._take(now, priority)
+                if not wait:
+                    return True
+
+                if not throttled:
+                    throttled = True
+                    self.throttled += 1
+
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    wait = min(wait, remaining)
+                self._condition.wait(wait)
+
+    async def acquire_async(self, priority=PRIORITY_CALL, timeout=None):
+        """Same as `acquire`, waiting without blocking the event loop"""
+        deadline = None if timeout is None else self._clock() + timeout
+        throttled = False
+        while True:
+            with self._condition:
+                now = self._clock()
+                wait = self._take(now, priority)
+                if not wait:
+                    return True
+
+                if not throttled:
+                    throttled = True
+                    self.throttled += 1
+
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    wait = min(wait, remaining)
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        with self._condition:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            self._tokens = 0
+
+    def _take(self, now, priority):
+        """Take a token when one is available for `priority` and return 0, else the seconds to wait"""
+        self._refill(now)
+        needed = min(1 + self._reserve * priority, self._rate)
+        if now >= self._paused_until and self._tokens >= needed:
+            self._tokens -= 1
+            return 0
+        return max(self._paused_until - now, (needed - self._tokens) / self._rate)
+
+    def _refill(self, now):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._tokens = min(self._rate, self._tokens + elapsed * self._rate)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(access_token, bucket, rate, reserve):
+    """Return the rate limiter of `bucket` shared by every source using the same token"""
+    key = (access_token, bucket)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(rate, reserve)
+        else:
+            limiter.configure(rate, reserve)
+        return limiter
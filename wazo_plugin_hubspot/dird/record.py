@@ -0,0 +1,55 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import sys
+
+
+class Record(tuple):
+    """
+    Values of the properties of a mirrored record, in the order of the fields
+    of its `RecordLayout`. Trailing empty values are not stored.
+    """
+
+    __slots__ = ()
+
+
+class RecordLayout:
+    """
+    Properties stored for the records of an object type.
+
+    The field names are shared by every record instead of being repeated in a
+    dict per record, and the id field is not stored, it is the record uid.
+    The values of `interned_fields` (e.g. the country) are interned, as few
+    distinct values are shared by many records.
+    """
+
+    def __init__(self, fields, id_field, interned_fields=()):
+        self.id_field = id_field
+        self.fields = tuple(sys.intern(field) for field in dict.fromkeys(fields) if field != id_field)
+        self._interned = tuple(field in interned_fields for field in self.fields)
+
+    def pack(self, properties):
+        values = []
+        for field, interned in zip(self.fields, self._interned):
+            value = properties.get(field)
+            if interned and isinstance(value, str):
+                value = sys.intern(value)
+            values.append(value)
+        while values and values[-1] is None:
+            values.pop()
+        return Record(values)
+
+    def unpack(self, uid, record):
+        """Return the properties of `record` as a new dict"""
+        properties = dict.fromkeys(self.fields)
+        properties.update(zip(self.fields, record))
+        properties[self.id_field] = uid
+        return properties
+
+    def size(self, record):
+        """Return the bytes used by `record` and by its values, interned ones excepted"""
+        return sys.getsizeof(record) + sum(
+            sys.getsizeof(value)
+            for value, interned in zip(record, self._interned)
+            if value is not None and not interned
+        )
@@ -0,0 +1,24 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+
+# Loaded backends by source uuid, for the resources acting on a running source
+_backends = {}
+_lock = threading.Lock()
+
+
+def register(source_uuid, backend):
+    with _lock:
+        _backends[source_uuid] = backend
+
+
+def unregister(source_uuid, backend):
+    with _lock:
+        if _backends.get(source_uuid) is backend:
+            del _backends[source_uuid]
+
+
+def get_backend(source_uuid):
+    with _lock:
+        return _backends.get(source_uuid)
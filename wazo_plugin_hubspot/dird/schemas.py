@@ -2,13 +2,131 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from xivo.mallow import fields
-from xivo.mallow.validate import Length
-from xivo.mallow_helpers import ListSchema as _ListSchema
+from xivo.mallow.validate import Length, OneOf, Range
+from xivo.mallow_helpers import ListSchema as _ListSchema, Schema
 from wazo_dird.schemas import BaseSourceSchema
 
 
+class RateLimitConfigSchema(Schema):
+    enabled = fields.Boolean(missing=True)
+    search_rate = fields.Integer(validate=Range(min=1), missing=4)
+    api_rate = fields.Integer(validate=Range(min=1), missing=10)
+    reserve = fields.Integer(validate=Range(min=0), missing=1)
+
+
+class CacheConfigSchema(Schema):
+    enabled = fields.Boolean(missing=True)
+    ttl = fields.Integer(validate=Range(min=0), missing=900)
+    negative_ttl = fields.Integer(validate=Range(min=0), missing=120)
+    max_entries = fields.Integer(validate=Range(min=0), missing=10000)
+    serve_stale = fields.Boolean(missing=True)
+    backend = fields.String(validate=OneOf(['memory', 'sqlite', 'redis']), missing='memory')
+    path = fields.String(validate=Length(min=1, max=1024), missing='/var/lib/wazo-dird/hubspot/cache.sqlite')
+    redis_url = fields.String(validate=Length(min=1, max=1024), allow_none=True, missing=None)
+
+
+class FirstMatchConfigSchema(Schema):
+    tiers = fields.List(
+        fields.String(validate=OneOf(['cache', 'filter', 'mirror', 'live'])),
+        validate=Length(min=1),
+        missing=['cache', 'filter', 'mirror', 'live'],
+    )
+    deadline = fields.Float(validate=Range(min=0), allow_none=True, missing=None)
+
+
+class CircuitBreakerConfigSchema(Schema):
+    enabled = fields.Boolean(missing=True)
+    failure_threshold = fields.Integer(validate=Range(min=1), missing=5)
+    cooldown = fields.Float(validate=Range(min=0), missing=30.0)
+
+
+class MirrorConfigSchema(Schema):
+    enabled = fields.Boolean(missing=False)
+    page_size = fields.Integer(validate=Range(min=1, max=100), missing=100)
+    refresh_interval = fields.Integer(validate=Range(min=1), missing=300)
+    archived_interval = fields.Integer(validate=Range(min=1), missing=3600)
+    snapshot = fields.Boolean(missing=True)
+    state_dir = fields.String(validate=Length(min=1, max=1024), missing='/var/lib/wazo-dird/hubspot')
+
+
+class AssociationsConfigSchema(Schema):
+    enabled = fields.Boolean(missing=False)
+
+
+class NumberFilterConfigSchema(Schema):
+    enabled = fields.Boolean(missing=False)
+    false_positive_rate = fields.Float(validate=Range(min=0.0001, max=0.5), missing=0.01)
+    min_capacity = fields.Integer(validate=Range(min=1), missing=100000)
+    page_size = fields.Integer(validate=Range(min=1, max=100), missing=100)
+    refresh_interval = fields.Integer(validate=Range(min=1), missing=300)
+    rebuild_interval = fields.Integer(validate=Range(min=1), missing=86400)
+    snapshot = fields.Boolean(missing=True)
+    state_dir = fields.String(validate=Length(min=1, max=1024), missing='/var/lib/wazo-dird/hubspot')
+
+
+class WebhookConfigSchema(Schema):
+    client_secret = fields.String(validate=Length(min=1, max=512), allow_none=True, missing=None)
+    url = fields.String(validate=Length(min=1, max=1024), allow_none=True, missing=None)
+    batch_interval = fields.Float(validate=Range(min=0.1), missing=2.0)
+    max_age = fields.Integer(validate=Range(min=1), missing=300)
+
+
+class WarmupConfigSchema(Schema):
+    enabled = fields.Boolean(missing=False)
+    numbers = fields.List(fields.String(validate=Length(min=1, max=64)), missing=[])
+    file = fields.String(validate=Length(min=1, max=1024), allow_none=True, missing=None)
+    interval = fields.Integer(validate=Range(min=0), missing=0)
+    batch_size = fields.Integer(validate=Range(min=1, max=100), missing=50)
+    max_numbers = fields.Integer(validate=Range(min=1), missing=10000)
+
+
+class PoolConfigSchema(Schema):
+    size = fields.Integer(validate=Range(min=1), missing=10)
+    keep_alive = fields.Boolean(missing=True)
+    connect_timeout = fields.Float(validate=Range(min=0), missing=1.0)
+    read_timeout = fields.Float(validate=Range(min=0), missing=3.0)
+    retries = fields.Integer(validate=Range(min=0), missing=2)
+    transport = fields.String(validate=OneOf(['sync', 'async']), missing='sync')
+
+
+class ObjectPropertiesSchema(Schema):
+    extra = fields.List(fields.String(validate=Length(min=1, max=128)), missing=[])
+    # Hubspot accepts up to 5 filter groups per search
+    search = fields.List(
+        fields.String(validate=Length(min=1, max=128)), validate=Length(min=1, max=5), allow_none=True, missing=None
+    )
+    match = fields.List(
+        fields.String(validate=Length(min=1, max=128)), validate=Length(min=1, max=5), allow_none=True, missing=None
+    )
+
+
+class PropertiesConfigSchema(Schema):
+    contacts = fields.Nested(ObjectPropertiesSchema, missing=lambda: ObjectPropertiesSchema().load({}))
+    companies = fields.Nested(ObjectPropertiesSchema, missing=lambda: ObjectPropertiesSchema().load({}))
+
+
 class SourceSchema(BaseSourceSchema):
     access_token = fields.String(required=True)
+    api_url = fields.String(validate=Length(min=1, max=1024), missing='https://api.hubapi.com')
+    default_region = fields.String(validate=Length(equal=2), allow_none=True, missing=None)
+    timeout = fields.Float(validate=Range(min=0), missing=3.0)
+    max_workers = fields.Integer(validate=Range(min=1), missing=8)
+    search_limit = fields.Integer(validate=Range(min=1, max=100), missing=10)
+    properties = fields.Nested(PropertiesConfigSchema, missing=lambda: PropertiesConfigSchema().load({}))
+    associations = fields.Nested(AssociationsConfigSchema, missing=lambda: AssociationsConfigSchema().load({}))
+    pool = fields.Nested(PoolConfigSchema, missing=lambda: PoolConfigSchema().load({}))
+    rate_limit = fields.Nested(RateLimitConfigSchema, missing=lambda: RateLimitConfigSchema().load({}))
+    circuit_breaker = fields.Nested(CircuitBreakerConfigSchema, missing=lambda: CircuitBreakerConfigSchema().load({}))
+    first_match = fields.Nested(FirstMatchConfigSchema, missing=lambda: FirstMatchConfigSchema().load({}))
+    cache = fields.Nested(CacheConfigSchema, missing=lambda: CacheConfigSchema().load({}))
+    mirror = fields.Nested(MirrorConfigSchema, missing=lambda: MirrorConfigSchema().load({}))
+    number_filter = fields.Nested(NumberFilterConfigSchema, missing=lambda: NumberFilterConfigSchema().load({}))
+    warmup = fields.Nested(WarmupConfigSchema, missing=lambda: WarmupConfigSchema().load({}))
+    webhook = fields.Nested(WebhookConfigSchema, missing=lambda: WebhookConfigSchema().load({}))
+
+
+class WarmSchema(Schema):
+    numbers = fields.List(fields.String(validate=Length(min=1, max=64)), validate=Length(max=10000), required=True)
 
 
 class ListSchema(_ListSchema):
@@ -23,3 +141,4 @@ class ListSchema(_ListSchema):
 source_list_schema = SourceSchema(many=True)
 source_schema = SourceSchema()
 list_schema = ListSchema()
+warm_schema = WarmSchema()
@@ -0,0 +1,375 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .cache import MISS, LookupCache, _no_tags
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Expired entries are kept this long for get_stale, then purged
+STALE_RETENTION = 24 * 3600
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_expiration ON entries (namespace, expires_at);
+CREATE TABLE IF NOT EXISTS tags (
+    namespace TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (namespace, tag, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_key ON tags (namespace, key);
+'''
+
+
+class SqliteCache:
+    """
+    `LookupCache` stored in a SQLite database, shared by every wazo-dird
+    process of the host using the same file.
+
+    Entries are keyed by `namespace`, the source uuid and the cache name, and
+    stored as JSON. When `max_entries` is exceeded, the entries closest to
+    expiration are evicted. Hit and miss counters are per process. The keys
+    of each tag (see `LookupCache`) are kept in the `tags` table.
+    """
+
+    # Entries are counted and purged every `PURGE_INTERVAL` writes only
+    PURGE_INTERVAL = 100
+
+    def __init__(self, path, namespace, max_entries, ttl, negative_ttl, clock=time.time, tags=None):
+        self.path = path
+        self._namespace = namespace
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self._tags = tags or _no_tags
+        self._writes = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SQLITE_SCHEMA)
+        self._db.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entry(key)
+        if entry is None or entry[1] <= self._clock():
+            self.misses += 1
+            return MISS
+        self.hits += 1
+        return entry[0]
+
+    def get_stale(self, key):
+        entry = self._entry(key)
+        return MISS if entry is None else entry[0]
+
+    def is_fresh(self, key):
+        entry = self._entry(key)
+        return entry is not None and entry[1] > self._clock()
+
+    def set(self, key, value):
+        ttl = self._ttl if value is not None else self._negative_ttl
+        if ttl <= 0 or self._max_entries <= 0:
+            return
+
+        key = json.dumps(key)
+        try:
+            with self._lock, self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                    (self._namespace, key, json.dumps(value), self._clock() + ttl),
+                )
+                self._db.execute('DELETE FROM tags WHERE namespace = ? AND key = ?', (self._namespace, key))
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO tags VALUES (?, ?, ?)',
+                    [(self._namespace, str(tag), key) for tag in self._tags(value)],
+                )
+                self._writes += 1
+                if self._writes % self.PURGE_INTERVAL == 0:
+                    self._purge()
+        except sqlite3.Error as e:
+            logger.warning('Could not write Hubspot cache %s: %s', self.path, e)
+
+    def invalidate(self, key):
+        key = (self._namespace, json.dumps(key))
+        try:
+            with self._lock, self._db:
+                self._db.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', key)
+                self._db.execute('DELETE FROM tags WHERE namespace = ? AND key = ?', key)
+        except sqlite3.Error as e:
+            logger.warning('Could not invalidate Hubspot cache %s: %s', self.path, e)
+
+    def invalidate_tagged(self, tags):
+        """Remove the entries having one of `tags`, return how many"""
+        removed = 0
+        try:
+            with self._lock, self._db:
+                for tag in set(tags):
+                    removed += self._db.execute(
+                        '''
+                        DELETE FROM entries WHERE namespace = ? AND key IN (
+                            SELECT key FROM tags WHERE namespace = ? AND tag = ?
+                        )
+                        ''',
+                        (self._namespace, self._namespace, str(tag)),
+                    ).rowcount
+                    self._db.execute('DELETE FROM tags WHERE namespace = ? AND tag = ?', (self._namespace, str(tag)))
+        except sqlite3.Error as e:
+            logger.warning('Could not invalidate Hubspot cache %s: %s', self.path, e)
+            return 0
+        return removed
+
+    def clear(self):
+        try:
+            with self._lock, self._db:
+                self._db.execute('DELETE FROM entries WHERE namespace = ?', (self._namespace,))
+                self._db.execute('DELETE FROM tags WHERE namespace = ?', (self._namespace,))
+        except sqlite3.Error as e:
+            logger.warning('Could not clear Hubspot cache %s: %s', self.path, e)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def as_dict(self):
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT COUNT(*) FROM entries WHERE namespace = ?', (self._namespace,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Could not read Hubspot cache %s: %s', self.path, e)
+            return 0
+        return row[0]
+
+    def _entry(self, key):
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?',
+                    (self._namespace, json.dumps(key)),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Could not read Hubspot cache %s: %s', self.path, e)
+            return None
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _purge(self):
+        self._db.execute(
+            'DELETE FROM entries WHERE namespace = ? AND expires_at < ?',
+            (self._namespace, self._clock() - STALE_RETENTION),
+        )
+        count = self._db.execute('SELECT COUNT(*) FROM entries WHERE namespace = ?', (self._namespace,)).fetchone()[0]
+        excess = count - self._max_entries
+        if excess > 0:
+            self._db.execute(
+                '''
+                DELETE FROM entries WHERE namespace = ? AND key IN (
+                    SELECT key FROM entries WHERE namespace = ? ORDER BY expires_at LIMIT ?
+                )
+                ''',
+                (self._namespace, self._namespace, excess),
+            )
+            self.evictions += excess
+        # Tags of the entries evicted or expired, the invalidated ones are already gone
+        self._db.execute(
+            'DELETE FROM tags WHERE namespace = ? AND key NOT IN (SELECT key FROM entries WHERE namespace = ?)',
+            (self._namespace, self._namespace),
+        )
+
+
+class RedisCache:
+    """
+    `LookupCache` stored in Redis, shared by the wazo-dird processes of every
+    host using the same server.
+
+    Entries are stored as JSON under `wazo-dird-hubspot:<namespace>:`, and
+    expire from Redis `STALE_RETENTION` seconds after their TTL. The number
+    of entries is bounded by the Redis `maxmemory` policy, not `max_entries`.
+
+    The keys of each tag (see `LookupCache`) are kept in a set, and every key
+    in a sorted set by expiration, so that neither invalidating a tag nor
+    counting the entries scans the namespace.
+    """
+
+    KEY_PREFIX = 'wazo-dird-hubspot'
+
+    # Seconds, an unreachable server must not hold calls for long
+    SOCKET_TIMEOUT = 1
+
+    def __init__(self, url, namespace, ttl, negative_ttl, clock=time.time, tags=None):
+        self._redis = redis.Redis.from_url(
+            url, socket_timeout=self.SOCKET_TIMEOUT, socket_connect_timeout=self.SOCKET_TIMEOUT
+        )
+        self._prefix = '{}:{}:'.format(self.KEY_PREFIX, namespace)
+        # Entry keys are JSON, they cannot start like these ones
+        self._keys = self._prefix + 'keys'
+        self._tag_prefix = self._prefix + 'tag:'
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self._tags = tags or _no_tags
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entry(key)
+        if entry is None or entry[1] <= self._clock():
+            self.misses += 1
+            return MISS
+        self.hits += 1
+        return entry[0]
+
+    def get_stale(self, key):
+        entry = self._entry(key)
+        return MISS if entry is None else entry[0]
+
+    def is_fresh(self, key):
+        entry = self._entry(key)
+        return entry is not None and entry[1] > self._clock()
+
+    def set(self, key, value):
+        ttl = self._ttl if value is not None else self._negative_ttl
+        if ttl <= 0:
+            return
+        expires_at = self._clock() + ttl
+        retention = int(ttl + STALE_RETENTION)
+        name = self._key(key)
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.set(name, json.dumps([value, expires_at]), ex=retention)
+        pipeline.zadd(self._keys, {name: expires_at + STALE_RETENTION})
+        for tag in self._tags(value):
+            pipeline.sadd(self._tag_prefix + str(tag), name)
+            pipeline.expire(self._tag_prefix + str(tag), retention)
+        try:
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning('Could not write Hubspot cache %s: %s', self._prefix, e)
+
+    def invalidate(self, key):
+        name = self._key(key)
+        try:
+            self._redis.pipeline(transaction=False).delete(name).zrem(self._keys, name).execute()
+        except redis.RedisError as e:
+            logger.warning('Could not invalidate Hubspot cache %s: %s', self._prefix, e)
+
+    def invalidate_tagged(self, tags):
+        """Remove the entries having one of `tags`, return how many"""
+        tag_names = [self._tag_prefix + str(tag) for tag in set(tags)]
+        if not tag_names:
+            return 0
+        try:
+            pipeline = self._redis.pipeline(transaction=False)
+            for tag_name in tag_names:
+                pipeline.smembers(tag_name)
+            names = set().union(*pipeline.execute())
+
+            pipeline = self._redis.pipeline(transaction=False)
+            pipeline.delete(*tag_names)
+            if names:
+                pipeline.delete(*names)
+                pipeline.zrem(self._keys, *names)
+            results = pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning('Could not invalidate Hubspot cache %s: %s', self._prefix, e)
+            return 0
+        return results[1] if names else 0
+
+    def clear(self):
+        try:
+            keys = list(self._redis.scan_iter(match=self._prefix + '*'))
+            if keys:
+                self._redis.delete(*keys)
+        except redis.RedisError as e:
+            logger.warning('Could not clear Hubspot cache %s: %s', self._prefix, e)
+
+    def close(self):
+        self._redis.close()
+
+    def as_dict(self):
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        pipeline = self._redis.pipeline(transaction=False)
+        # Entries expired from Redis are still in the sorted set until then
+        pipeline.zremrangebyscore(self._keys, '-inf', self._clock())
+        pipeline.zcard(self._keys)
+        try:
+            return pipeline.execute()[1]
+        except redis.RedisError as e:
+            logger.warning('Could not read Hubspot cache %s: %s', self._prefix, e)
+            return 0
+
+    def _key(self, key):
+        return self._prefix + json.dumps(key)
+
+    def _entry(self, key):
+        try:
+            entry = self._redis.get(self._key(key))
+        except redis.RedisError as e:
+            logger.warning('Could not read Hubspot cache %s: %s', self._prefix, e)
+            return None
+        if entry is None:
+            return None
+        value, expires_at = json.loads(entry)
+        return value, expires_at
+
+
+def create_cache(cache_config, namespace, max_entries, ttl, negative_ttl, tags=None):
+    """
+    Return the cache of `namespace` on the `backend` of the cache
+    configuration, or an in-process `LookupCache` if it cannot be used
+    """
+    backend = cache_config.get('backend', 'memory')
+    try:
+        if backend == 'sqlite':
+            return SqliteCache(cache_config['path'], namespace, max_entries, ttl, negative_ttl, tags=tags)
+        if backend == 'redis':
+            if redis is None:
+                logger.error('redis is not installed, using an in-process cache for %s', namespace)
+            else:
+                return RedisCache(cache_config['redis_url'], namespace, ttl, negative_ttl, tags=tags)
+    except (KeyError, OSError, sqlite3.Error) as e:
+        logger.error('Could not open the %s cache of %s, using an in-process cache: %s', backend, namespace, e)
+    return LookupCache(max_entries=max_entries, ttl=ttl, negative_ttl=negative_ttl, tags=tags)
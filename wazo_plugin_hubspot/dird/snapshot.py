@@ -0,0 +1,247 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 3
+
+# Changes kept for the processes following the snapshot, a process further behind reloads it all
+MAX_CHANGES = 100000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    object_type TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    properties TEXT NOT NULL,
+    PRIMARY KEY (object_type, uid)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS phones (
+    number TEXT NOT NULL,
+    object_type TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    PRIMARY KEY (number, object_type, uid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS phones_record ON phones (object_type, uid);
+CREATE TABLE IF NOT EXISTS watermarks (
+    object_type TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS properties (
+    object_type TEXT PRIMARY KEY,
+    names TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    object_type TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    writer INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+
+class Snapshot:
+    """
+    On-disk copy of a `Mirror` and of its phone index, in a SQLite database.
+
+    It lets a restarted source answer reverse lookups at once, and resume the
+    synchronization from the stored high-water marks instead of a full pull.
+    The properties pulled for each object type are stored too: a snapshot of
+    other properties is not up to date, even for unmodified records.
+
+    It is also shared by the wazo-dird processes of the host: the one holding
+    its lock (see `try_lock`) synchronizes it with Hubspot, the others follow
+    it. Each full save starts a new generation, and the records changed since
+    are logged, so that a follower only reads the changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._writer = os.getpid()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            logger.info('Resetting Hubspot snapshot %s (version %s)', path, version)
+            self._db.executescript(
+                'DROP TABLE IF EXISTS records; DROP TABLE IF EXISTS phones; DROP TABLE IF EXISTS watermarks;'
+                'DROP TABLE IF EXISTS properties; DROP TABLE IF EXISTS changes; DROP TABLE IF EXISTS meta;'
+            )
+        self._db.executescript(SCHEMA)
+        self._db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self._db.commit()
+
+    def try_lock(self):
+        """Return whether this process holds the lock of the snapshot, taking it if it is free"""
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.path + '.lock', 'a')
+        try:
+            # Released by the system when the process exits
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def position(self):
+        """Return the generation of the snapshot and the sequence number of its last change"""
+        with self._lock:
+            return self._position()
+
+    def changes(self, since):
+        """
+        Return the `(object_type, uid, properties)` records changed by other
+        processes after the `since` sequence number, with None properties when
+        removed, and the sequence number of the last change. Return None when
+        these changes are not kept anymore.
+        """
+        with self._lock:
+            if since < self._meta('pruned'):
+                return None
+            rows = self._db.execute(
+                '''
+                SELECT changes.seq, changes.object_type, changes.uid, records.properties, changes.writer
+                FROM changes LEFT JOIN records USING (object_type, uid)
+                WHERE changes.seq > ?
+                ORDER BY changes.seq
+                ''',
+                (since,),
+            ).fetchall()
+        records = [
+            (object_type, uid, json.loads(properties) if properties is not None else None)
+            for _, object_type, uid, properties, writer in rows
+            if writer != self._writer
+        ]
+        return records, rows[-1][0] if rows else since
+
+    def request_full_sync(self):
+        """Ask the process holding the lock for a full sync"""
+        with self._lock, self._db:
+            self._set_meta('full_sync_requested', 1)
+
+    def take_full_sync_request(self):
+        """Return whether a full sync was requested, and forget the request"""
+        with self._lock, self._db:
+            requested = self._meta('full_sync_requested')
+            self._set_meta('full_sync_requested', 0)
+        return bool(requested)
+
+    def watermarks(self):
+        with self._lock:
+            return dict(self._db.execute('SELECT object_type, value FROM watermarks'))
+
+    def properties(self):
+        """Return the names of the properties stored, by object type"""
+        with self._lock:
+            rows = self._db.execute('SELECT object_type, names FROM properties').fetchall()
+        return {object_type: json.loads(names) for object_type, names in rows}
+
+    def records(self):
+        """Return every `(object_type, uid, properties)` stored"""
+        with self._lock:
+            rows = self._db.execute('SELECT object_type, uid, properties FROM records').fetchall()
+        return [(object_type, uid, json.loads(properties)) for object_type, uid, properties in rows]
+
+    def lookup_number(self, number):
+        """Return `(object_type, properties)` of the first record using `number`, or None"""
+        with self._lock:
+            row = self._db.execute(
+                '''
+                SELECT records.object_type, records.properties
+                FROM phones JOIN records USING (object_type, uid)
+                WHERE phones.number = ?
+                ORDER BY records.object_type = 'contacts' DESC
+                LIMIT 1
+                ''',
+                (number,),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def save(self, items, watermarks, properties):
+        """
+        Replace the content of the snapshot with `(object_type, uid,
+        properties, numbers)` items, having the `properties` names by object
+        type. Return its new position, see `position`.
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM records')
+            self._db.execute('DELETE FROM phones')
+            self._db.execute('DELETE FROM watermarks')
+            self._db.execute('DELETE FROM properties')
+            self._db.execute('DELETE FROM changes')
+            self._set_meta('generation', self._meta('generation') + 1)
+            self._insert(items)
+            self._set_watermarks(watermarks)
+            self._db.executemany(
+                'INSERT INTO properties VALUES (?, ?)',
+                [(object_type, json.dumps(names)) for object_type, names in properties.items()],
+            )
+            return self._position()
+
+    def apply(self, upserts, removals, watermarks):
+        with self._lock, self._db:
+            keys = [(object_type, uid) for object_type, uid, _, _ in upserts] + list(removals)
+            self._db.executemany('DELETE FROM records WHERE object_type = ? AND uid = ?', keys)
+            self._db.executemany('DELETE FROM phones WHERE object_type = ? AND uid = ?', keys)
+            self._insert(upserts)
+            self._set_watermarks(watermarks)
+            self._db.executemany(
+                'INSERT INTO changes (object_type, uid, writer) VALUES (?, ?, ?)',
+                [(object_type, uid, self._writer) for object_type, uid in keys],
+            )
+            _, seq = self._position()
+            if seq > self._meta('pruned') + 2 * MAX_CHANGES:
+                self._db.execute('DELETE FROM changes WHERE seq <= ?', (seq - MAX_CHANGES,))
+                self._set_meta('pruned', seq - MAX_CHANGES)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    def _insert(self, items):
+        for object_type, uid, properties, numbers in items:
+            self._db.execute(
+                'INSERT OR REPLACE INTO records VALUES (?, ?, ?)',
+                (object_type, uid, json.dumps(properties, separators=(',', ':'))),
+            )
+            self._db.executemany(
+                'INSERT OR IGNORE INTO phones VALUES (?, ?, ?)',
+                [(number, object_type, uid) for number in numbers],
+            )
+
+    def _position(self):
+        # Sequence numbers are not reused, even after the changes are deleted
+        row = self._db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return self._meta('generation'), row[0] if row is not None else 0
+
+    def _meta(self, name):
+        row = self._db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def _set_meta(self, name, value):
+        self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+
+    def _set_watermarks(self, watermarks):
+        self._db.executemany('INSERT OR REPLACE INTO watermarks VALUES (?, ?)', watermarks.items())
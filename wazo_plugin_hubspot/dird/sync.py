@@ -0,0 +1,365 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import sqlite3
+import threading
+import time
+
+from itertools import chain
+
+from hubspot.crm.contacts import PublicObjectSearchRequest
+
+from .client import UPSTREAM_ERRORS
+from .mirror import COMPANIES, CONTACTS
+from .ratelimit import PRIORITY_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+
+def _to_millis(value):
+    return int(value.timestamp() * 1000)
+
+
+class SyncStopped(Exception):
+    """The synchronizer was stopped while fetching pages"""
+
+
+class MirrorSynchronizer:
+    """
+    Keeps a `Mirror` up to date with Hubspot.
+
+    A full pull is done once, then only objects modified since the last known
+    modification date (the high-water mark) are fetched and upserted. Deleted
+    objects are removed by a less frequent pass over archived objects.
+
+    With a `Snapshot`, every change is also written to disk, and a restarted
+    source restores the mirror from it then only catches up on the changes.
+    The snapshot is shared by the wazo-dird processes of the host: only the
+    process holding its lock calls Hubspot, the others follow the changes it
+    writes every `FOLLOW_INTERVAL` seconds, and take over when it exits.
+    """
+
+    MODIFIED_FIELDS = {
+        CONTACTS: 'lastmodifieddate',
+        COMPANIES: 'hs_lastmodifieddate',
+    }
+
+    # The search API refuses to page past 10000 results
+    SEARCH_RESULTS_CAP = 10000
+
+    FOLLOW_INTERVAL = 5
+
+    def __init__(self, name, mirror, client, properties, page_size, refresh_interval, archived_interval,
+                 snapshot=None, full_sync_interval=None):
+        self._name = name
+        self._mirror = mirror
+        self._snapshot = snapshot
+        self._client = client
+        self._properties = properties
+        self._page_size = page_size
+        self._refresh_interval = refresh_interval
+        self._archived_interval = archived_interval
+        self._full_sync_interval = full_sync_interval
+        self._last_full_sync = time.monotonic()
+        self._watermarks = {}
+        self._last_archived_pass = time.monotonic()
+        self._next_refresh = 0
+        self._synced = False
+        self._generation = None
+        self._seq = 0
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._full_sync_requested = False
+        self._thread = None
+        self.leading = snapshot is None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='hubspot-sync-{}'.format(self._name),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def request_full_sync(self):
+        """Pull every object again as soon as possible, instead of the next delta sync"""
+        if not self.leading:
+            # Done by the process synchronizing the snapshot, which this one follows
+            self._save_snapshot(self._snapshot.request_full_sync)
+            return
+        self._full_sync_requested = True
+        self._next_refresh = 0
+        self._wakeup.set()
+
+    def full_sync(self):
+        logger.info('Starting Hubspot full sync for source %s', self._name)
+        started_at = int(time.time() * 1000)
+        records = list(chain(self._fetch_all(CONTACTS), self._fetch_all(COMPANIES)))
+        items = self._mirror.replace(records)
+        self._watermarks = {object_type: started_at for object_type in self._properties}
+        logger.info('Hubspot full sync done for source %s: %s records', self._name, len(records))
+        position = self._save_snapshot(lambda: self._snapshot.save(items, self._watermarks, self._properties))
+        if position is not None:
+            self._generation, self._seq = position
+
+    def restore(self):
+        """Load the mirror from the snapshot, return False if there is nothing to restore"""
+        self._generation, self._seq = self._snapshot.position()
+        watermarks = self._snapshot.watermarks()
+        if set(watermarks) != set(self._properties):
+            return False
+        if self._snapshot.properties() != self._properties:
+            logger.info('Hubspot properties of source %s changed since its snapshot, pulling them all', self._name)
+            return False
+
+        records = self._snapshot.records()
+        self._mirror.replace(records)
+        self._watermarks = watermarks
+        logger.info('Hubspot mirror of source %s restored from snapshot: %s records', self._name, len(records))
+        return True
+
+    def delta_sync(self):
+        upserts = []
+        for object_type in self._properties:
+            for result in self._fetch_modified(object_type):
+                upserts.append(self._mirror.upsert(object_type, result.id, result.properties))
+                if result.updated_at:
+                    self._watermarks[object_type] = max(
+                        self._watermarks[object_type], _to_millis(result.updated_at)
+                    )
+        logger.debug('Hubspot delta sync for source %s: %s records updated', self._name, len(upserts))
+        self._save_snapshot(lambda: self._snapshot.apply(upserts, [], self._watermarks))
+
+    def purge_archived(self):
+        removals = []
+        for object_type in self._properties:
+            for _, uid, _ in self._fetch_all(object_type, archived=True):
+                self._mirror.remove(object_type, uid)
+                removals.append((object_type, uid))
+        logger.debug('Hubspot archived pass for source %s: %s records removed', self._name, len(removals))
+        self._save_snapshot(lambda: self._snapshot.apply([], removals, self._watermarks))
+
+    def apply_changes(self, upserts, removals):
+        """
+        Apply changes pushed by Hubspot: `(object_type, uid, properties)`
+        upserts and `(object_type, uid)` removals
+        """
+        items = [self._mirror.upsert(object_type, uid, properties) for object_type, uid, properties in upserts]
+        for object_type, uid in removals:
+            self._mirror.remove(object_type, uid)
+        # Only the process synchronizing the snapshot knows its high-water marks
+        watermarks = dict(self._watermarks) if self.leading else {}
+        self._save_snapshot(lambda: self._snapshot.apply(items, removals, watermarks))
+
+    def _run(self):
+        if self._snapshot is not None:
+            self._synced = self._restore()
+            if self._synced:
+                # Catch up at once on what changed while the source was not loaded
+                self._last_archived_pass = float('-inf')
+
+        while not self._stopped.is_set():
+            try:
+                if self._lead():
+                    self._sync()
+                else:
+                    self._follow()
+            except Exception:
+                # The next pass may succeed, this thread must not end
+                logger.exception('Hubspot sync of source %s failed', self._name)
+            self._wait()
+
+    def _lead(self):
+        """Return whether this process synchronizes the mirror with Hubspot, taking over when it can"""
+        if self.leading:
+            return True
+        try:
+            self.leading = self._snapshot.try_lock()
+        except OSError as e:
+            logger.error('Could not lock Hubspot snapshot of source %s, synchronizing it anyway: %s', self._name, e)
+            self.leading = True
+        if not self.leading:
+            return False
+
+        logger.info('Synchronizing the Hubspot mirror of source %s', self._name)
+        # Resume from the changes written by the previous owner of the lock
+        self._follow()
+        try:
+            self._watermarks = self._snapshot.watermarks()
+        except sqlite3.Error as e:
+            logger.error('Could not read Hubspot snapshot of source %s: %s', self._name, e)
+            self._synced = False
+        if set(self._watermarks) != set(self._properties):
+            self._synced = False
+        return True
+
+    def _sync(self):
+        if self._snapshot is not None:
+            # Changes applied by the processes following the snapshot, from webhook events
+            self._follow_changes()
+            if self._save_snapshot(self._snapshot.take_full_sync_request):
+                self._full_sync_requested = True
+                self._next_refresh = 0
+
+        now = time.monotonic()
+        if now < self._next_refresh:
+            return
+        self._next_refresh = now + self._refresh_interval
+
+        if self._full_sync_interval is not None and now - self._last_full_sync >= self._full_sync_interval:
+            self._full_sync_requested = True
+
+        if self._full_sync_requested or not self._synced:
+            # Retried at the next refresh if it fails
+            if self._try_full_sync():
+                self._synced = True
+                self._full_sync_requested = False
+                self._last_full_sync = time.monotonic()
+        else:
+            self._refresh()
+
+    def _follow(self):
+        """Load what the process synchronizing the snapshot wrote to it"""
+        try:
+            generation, _ = self._snapshot.position()
+            if generation != self._generation:
+                self._synced = self.restore()
+            else:
+                self._follow_changes()
+        except sqlite3.Error as e:
+            logger.error('Could not read Hubspot snapshot of source %s: %s', self._name, e)
+
+    def _follow_changes(self):
+        try:
+            changes = self._snapshot.changes(self._seq)
+            if changes is None:
+                # Too far behind, the changes are not kept anymore
+                self._synced = self.restore()
+                return
+        except sqlite3.Error as e:
+            logger.error('Could not read Hubspot snapshot of source %s: %s', self._name, e)
+            return
+
+        records, self._seq = changes
+        for object_type, uid, properties in records:
+            if properties is None:
+                self._mirror.remove(object_type, uid)
+            else:
+                self._mirror.upsert(object_type, uid, properties)
+        if records:
+            logger.debug('Hubspot mirror of source %s: %s changes followed', self._name, len(records))
+
+    def _restore(self):
+        try:
+            return self.restore()
+        except sqlite3.Error as e:
+            logger.error('Could not restore Hubspot snapshot of source %s: %s', self._name, e)
+            return False
+
+    def _wait(self):
+        """Wait for the next refresh, a requested full sync, or the changes to follow"""
+        timeout = max(0, self._next_refresh - time.monotonic())
+        if self._snapshot is not None:
+            timeout = min(timeout, self.FOLLOW_INTERVAL)
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def _try_full_sync(self):
+        try:
+            self.full_sync()
+            return True
+        except SyncStopped:
+            logger.info('Hubspot full sync of source %s interrupted', self._name)
+            return False
+        except UPSTREAM_ERRORS as e:
+            logger.error('Hubspot full sync failed for source %s: %s', self._name, e)
+            return False
+
+    def _refresh(self):
+        try:
+            self.delta_sync()
+            if time.monotonic() - self._last_archived_pass >= self._archived_interval:
+                self.purge_archived()
+                self._last_archived_pass = time.monotonic()
+        except SyncStopped:
+            logger.info('Hubspot delta sync of source %s interrupted', self._name)
+        except UPSTREAM_ERRORS as e:
+            logger.error('Hubspot delta sync failed for source %s: %s', self._name, e)
+
+    def _save_snapshot(self, save):
+        if self._snapshot is None:
+            return None
+        try:
+            return save()
+        except sqlite3.Error as e:
+            logger.error('Could not write Hubspot snapshot of source %s: %s', self._name, e)
+            return None
+
+    def _check_stopped(self):
+        # Stopping the source waits for this thread, which must not wait for the end of a sync
+        if self._stopped.is_set():
+            raise SyncStopped()
+
+    def _fetch_all(self, object_type, archived=False):
+        after = None
+        while True:
+            self._check_stopped()
+            page = self._client.get_page(
+                object_type,
+                priority=PRIORITY_BACKGROUND,
+                limit=self._page_size,
+                after=after,
+                properties=self._properties[object_type],
+                archived=archived,
+            )
+            for result in page.results:
+                yield object_type, result.id, result.properties
+
+            if not page.paging or not page.paging.next:
+                return
+            after = page.paging.next.after
+
+    def _fetch_modified(self, object_type):
+        modified_field = self.MODIFIED_FIELDS[object_type]
+        since = self._watermarks[object_type]
+        after = None
+        while True:
+            self._check_stopped()
+            request = PublicObjectSearchRequest(
+                filter_groups=[
+                    {
+                        "filters": [
+                            {
+                                "value": str(since),
+                                "propertyName": modified_field,
+                                "operator": "GTE"
+                            }
+                        ]
+                    },
+                ],
+                sorts=[{"propertyName": modified_field, "direction": "ASCENDING"}],
+                properties=self._properties[object_type],
+                limit=self._page_size,
+                after=after,
+            )
+            page = self._client.search(object_type, request, priority=PRIORITY_BACKGROUND)
+            for result in page.results:
+                yield result
+                if result.updated_at:
+                    since = max(since, _to_millis(result.updated_at))
+
+            if not page.paging or not page.paging.next:
+                return
+            after = page.paging.next.after
+            if int(after) + self._page_size > self.SEARCH_RESULTS_CAP:
+                # Start a new query from the last modification date seen
+                after = None
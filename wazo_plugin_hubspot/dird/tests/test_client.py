@@ -0,0 +1,50 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from unittest.mock import Mock
+
+from hubspot.crm.associations import ApiException as AssociationsApiException
+from hubspot.crm.companies import ApiException as CompaniesApiException
+
+from ..client import UPSTREAM_ERRORS, HubspotClient
+from ..ratelimit import PRIORITY_CALL, RateLimitedError
+
+
+def api_exception(exception_class, status, headers=None):
+    e = exception_class(status=status, reason='error')
+    e.headers = headers
+    return e
+
+
+class TestHubspotClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = HubspotClient('token', 'http://localhost', {}, {'enabled': False})
+        self.limiter = Mock()
+        self.limiter.acquire.return_value = True
+
+    def test_companies_rate_limited_pauses_the_limiter(self):
+        method = Mock(side_effect=api_exception(CompaniesApiException, 429, {'Retry-After': '2'}))
+
+        with self.assertRaises(RateLimitedError):
+            self.client._call(self.limiter, PRIORITY_CALL, None, method)
+
+        self.limiter.pause.assert_called_once_with(2.0)
+
+    def test_associations_rate_limited_pauses_the_limiter(self):
+        method = Mock(side_effect=api_exception(AssociationsApiException, 429))
+
+        with self.assertRaises(RateLimitedError):
+            self.client._call(self.limiter, PRIORITY_CALL, None, method)
+
+        self.limiter.pause.assert_called_once_with(1)
+
+    def test_companies_errors_are_upstream_errors(self):
+        method = Mock(side_effect=api_exception(CompaniesApiException, 503))
+
+        with self.assertRaises(UPSTREAM_ERRORS):
+            self.client._call(self.limiter, PRIORITY_CALL, None, method)
+
+        self.limiter.pause.assert_not_called()
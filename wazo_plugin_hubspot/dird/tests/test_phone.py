@@ -0,0 +1,24 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from .. import phone
+
+
+class TestToE164(unittest.TestCase):
+
+    def test_national_number(self):
+        self.assertEqual(phone.to_e164('06 12 34 56 78', 'FR'), '+33612345678')
+
+    def test_international_number(self):
+        self.assertEqual(phone.to_e164('+44 20 7946 0958', 'FR'), '+442079460958')
+
+    def test_extension_is_not_a_number(self):
+        self.assertIsNone(phone.to_e164('1234', 'FR'))
+
+    def test_short_code_is_not_a_number(self):
+        self.assertIsNone(phone.to_e164('112', 'FR'))
+
+    def test_text_is_not_a_number(self):
+        self.assertIsNone(phone.to_e164('dupont', 'FR'))
@@ -0,0 +1,141 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import copy
+import time
+import unittest
+
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from hubspot.crm.companies import ApiException as CompaniesApiException
+
+from .. import plugin
+from ..breaker import OPEN
+from ..mirror import COMPANIES, CONTACTS
+
+CONFIG = {
+    'name': 'test',
+    'uuid': 'test',
+    'access_token': 'token',
+    'default_region': 'FR',
+    'timeout': 1.0,
+    'format_columns': {
+        'name': '{firstname} {lastname} {name}',
+        'phone': '{phone}',
+    },
+    'first_matched_columns': ['phone'],
+}
+
+
+def response(*objects):
+    return SimpleNamespace(
+        results=[SimpleNamespace(id=uid, properties=dict(properties, hs_object_id=uid)) for uid, properties in objects],
+        paging=None,
+    )
+
+
+class BackendTestCase(unittest.TestCase):
+
+    config = {}
+
+    def setUp(self):
+        self.client = Mock(is_async=False)
+        self.client.get_page.return_value = response()
+        self.client.search.return_value = response()
+        patcher = patch.multiple(plugin, acquire_client=Mock(return_value=self.client), release_client=Mock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        config = copy.deepcopy(CONFIG)
+        config.update(copy.deepcopy(self.config))
+        self.backend = plugin.HubspotBackend()
+        self.backend.load({'config': config})
+        self.addCleanup(self.backend.unload)
+
+
+class TestSearch(BackendTestCase):
+
+    def test_companies_error_returns_the_contacts(self):
+        def search(object_type, request, **kwargs):
+            if object_type == COMPANIES:
+                raise CompaniesApiException(status=503, reason='Service Unavailable')
+            return response(('1', {'firstname': 'Alice', 'lastname': 'Dupont'}))
+        self.client.search.side_effect = search
+
+        result, records = self.backend._search('dupont')
+
+        self.assertEqual(result, 'error')
+        self.assertEqual([properties['hs_object_id'] for properties in records], ['1'])
+
+
+class TestFirstMatch(BackendTestCase):
+
+    def test_extension_is_not_looked_up(self):
+        result = self.backend._first_match('1234')
+
+        self.assertEqual(result, ('invalid', None))
+        self.client.search.assert_not_called()
+
+
+class TestCircuitBreaker(BackendTestCase):
+
+    config = {'circuit_breaker': {'failure_threshold': 1}}
+
+    def test_companies_server_error_is_a_failure(self):
+        def search(object_type, request, **kwargs):
+            if object_type == COMPANIES:
+                raise CompaniesApiException(status=503, reason='Service Unavailable')
+            return response()
+        self.client.search.side_effect = search
+
+        self.backend._search('dupont')
+
+        # Outcomes are recorded by the worker threads, right after the results are returned
+        deadline = time.monotonic() + 1
+        while self.backend._breaker.state != OPEN and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.backend._breaker.state, OPEN)
+
+
+class TestList(BackendTestCase):
+
+    def test_contact_and_company_sharing_an_id(self):
+        objects = {
+            CONTACTS: ('7', {'firstname': 'Alice', 'lastname': 'Dupont'}),
+            COMPANIES: ('7', {'name': 'Dupont SA'}),
+        }
+        self.client.batch_read.side_effect = lambda object_type, ids, properties, **kwargs: response(
+            objects[object_type]
+        )
+
+        result, records = self.backend._list(['7'])
+
+        self.assertEqual(result, 'miss')
+        self.assertEqual(records[(CONTACTS, '7')]['firstname'], 'Alice')
+        self.assertEqual(records[(COMPANIES, '7')]['name'], 'Dupont SA')
+
+    def test_missing_object_type_is_not_read_again(self):
+        self.client.batch_read.side_effect = lambda object_type, ids, properties, **kwargs: response(
+            *([('7', {'name': 'Dupont SA'})] if object_type == COMPANIES else [])
+        )
+        self.backend._list(['7'])
+        self.client.batch_read.reset_mock()
+
+        result, records = self.backend._list(['7'])
+
+        self.assertEqual(result, 'hit')
+        self.assertEqual(list(records), [(COMPANIES, '7')])
+        self.client.batch_read.assert_not_called()
+
+
+class TestWarm(BackendTestCase):
+
+    config = {'mirror': {'enabled': True, 'snapshot': False}}
+
+    def test_mirror_answers_lookups(self):
+        invalid = self.backend.warm(['+33612345678', '1234'])
+        self.backend._warmups.shutdown(wait=True)
+
+        self.assertEqual(invalid, ['1234'])
+        self.client.search.assert_not_called()
@@ -0,0 +1,50 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import unittest
+
+from ..shared_cache import SqliteCache
+
+
+def record_tags(properties):
+    if properties is None:
+        return []
+    return [uid for uid in (properties['id'], properties.get('company_id')) if uid]
+
+
+class TestSqliteCacheTags(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.clock = [1000.0]
+        self.cache = SqliteCache(
+            os.path.join(directory.name, 'cache', 'hubspot.db'),
+            'source:lookup',
+            max_entries=100,
+            ttl=60,
+            negative_ttl=30,
+            clock=lambda: self.clock[0],
+            tags=record_tags,
+        )
+
+    def test_invalidate_tagged(self):
+        self.cache.set('+33612345678', {'id': '1', 'company_id': '9'})
+        self.cache.set('+33612345679', {'id': '2', 'company_id': '9'})
+        self.cache.set('+33612345670', {'id': '3'})
+        self.cache.set('+33612345671', None)
+
+        self.assertEqual(self.cache.invalidate_tagged(['9']), 2)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get('+33612345670'), {'id': '3'})
+        self.assertIsNone(self.cache.get('+33612345671'))
+
+    def test_replaced_entry_loses_its_tags(self):
+        self.cache.set('+33612345678', {'id': '1', 'company_id': '9'})
+        self.cache.set('+33612345678', {'id': '1'})
+
+        self.assertEqual(self.cache.invalidate_tagged(['9']), 0)
+        self.assertEqual(self.cache.get('+33612345678'), {'id': '1'})
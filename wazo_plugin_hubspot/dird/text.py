@@ -0,0 +1,10 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unicodedata
+
+
+def fold(value):
+    """Lower case `value` and strip its accents, "Équipe" becomes "equipe\""""
+    decomposed = unicodedata.normalize('NFKD', value)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold().strip()
@@ -0,0 +1,80 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import csv
+import logging
+import threading
+
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Caller number column of the wazo-call-logd CSV export
+CDR_NUMBER_COLUMN = 'source_extension'
+
+
+def read_numbers(path):
+    """
+    Return the numbers of a file: one number per line, or a CSV export of the
+    call logs, whose `source_extension` column is used.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        sample = f.readline()
+        f.seek(0)
+        if CDR_NUMBER_COLUMN in sample:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+            return [row[CDR_NUMBER_COLUMN] for row in csv.DictReader(f, dialect=dialect) if row.get(CDR_NUMBER_COLUMN)]
+        return [line.strip() for line in f if line.strip()]
+
+
+class CacheWarmer:
+    """
+    Resolves the numbers of recent callers into the reverse lookup cache, when
+    the source is loaded then every `interval` seconds (0 to run only once).
+
+    Numbers come from the configuration and from a file, re-read on every
+    run. The most frequent callers go first, up to `max_numbers`. `warm` is
+    called with them and with the event set when the warmer is stopped.
+    """
+
+    def __init__(self, name, warm, numbers, path, interval, max_numbers):
+        self._name = name
+        self._warm = warm
+        self._numbers = numbers
+        self._path = path
+        self._interval = interval
+        self._max_numbers = max_numbers
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='hubspot-warmup-{}'.format(self._name),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def recent_numbers(self):
+        numbers = Counter(self._numbers)
+        if self._path:
+            try:
+                numbers.update(read_numbers(self._path))
+            except (OSError, csv.Error, UnicodeDecodeError) as e:
+                logger.error('Could not read recent callers of source %s from %s: %s', self._name, self._path, e)
+        return [number for number, _ in numbers.most_common(self._max_numbers)]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            numbers = self.recent_numbers()
+            logger.info('Warming up Hubspot lookup cache of source %s: %s numbers', self._name, len(numbers))
+            self._warm(numbers, self._stopped)
+            if not self._interval or self._stopped.wait(self._interval):
+                return
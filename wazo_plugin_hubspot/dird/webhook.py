@@ -0,0 +1,175 @@
+# Copyright 2023 École Hexagone (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from urllib.parse import unquote
+
+from .mirror import COMPANIES, CONTACTS
+
+logger = logging.getLogger(__name__)
+
+OBJECT_TYPES = {
+    'contact': CONTACTS,
+    'company': COMPANIES,
+}
+
+DELETION_EVENTS = ('deletion', 'privacyDeletion')
+
+# Side of the contact in the association changes of a contact and a company
+CONTACT_ASSOCIATIONS = {
+    'CONTACT_TO_COMPANY': 'fromObjectId',
+    'COMPANY_TO_CONTACT': 'toObjectId',
+}
+
+# Deliveries retried by Hubspot are recognized by their event id
+SEEN_EVENTS_SIZE = 10000
+
+
+def verify_signature(client_secret, method, url, body, headers, max_age):
+    """
+    Check the signature of a Hubspot webhook request, see
+    https://developers.hubspot.com/docs/api/webhooks/validating-requests
+    """
+    signature = headers.get('X-HubSpot-Signature-v3')
+    if signature:
+        timestamp = headers.get('X-HubSpot-Request-Timestamp', '')
+        try:
+            age = time.time() - int(timestamp) / 1000
+        except ValueError:
+            return False
+        if age > max_age:
+            logger.info('Hubspot webhook request rejected, sent %ds ago', age)
+            return False
+        source = method + unquote(url) + body.decode('utf-8') + timestamp
+        digest = hmac.new(client_secret.encode('utf-8'), source.encode('utf-8'), hashlib.sha256).digest()
+        return hmac.compare_digest(base64.b64encode(digest).decode('ascii'), signature)
+
+    signature = headers.get('X-HubSpot-Signature')
+    if not signature:
+        return False
+    if headers.get('X-HubSpot-Signature-Version') == 'v2':
+        source = client_secret + method + url + body.decode('utf-8')
+    else:
+        source = client_secret + body.decode('utf-8')
+    digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+    return hmac.compare_digest(digest, signature)
+
+
+class WebhookBatcher:
+    """
+    Collects Hubspot webhook events and applies them in batches.
+
+    Events are de-duplicated per object, so that a bulk import modifying the
+    same objects many times results in one read per object. Every
+    `interval` seconds, `apply(modified, deleted)` is called with the ids of
+    the objects modified and deleted, grouped by object type.
+    """
+
+    def __init__(self, name, apply, interval, properties):
+        self._name = name
+        self._apply = apply
+        self._interval = interval
+        self._properties = properties
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._seen = OrderedDict()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.received = 0
+        self.duplicates = 0
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='hubspot-webhook-{}'.format(self._name),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def add(self, events):
+        with self._lock:
+            for event in events:
+                self.received += 1
+                if self._is_duplicate(event.get('eventId')):
+                    self.duplicates += 1
+                    continue
+                self._add(event)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        modified = {}
+        deleted = {}
+        for (object_type, uid), (_, deletion) in pending.items():
+            changes = deleted if deletion else modified
+            changes.setdefault(object_type, []).append(uid)
+
+        logger.debug('Applying Hubspot webhook events of source %s: %s', self._name, len(pending))
+        try:
+            self._apply(modified, deleted)
+        except Exception:
+            logger.exception('Could not apply Hubspot webhook events of source %s', self._name)
+
+    def _add(self, event):
+        object_kind, _, action = event.get('subscriptionType', '').partition('.')
+        if action == 'associationChange':
+            self._add_association(event)
+            return
+
+        object_type = OBJECT_TYPES.get(object_kind)
+        if object_type is None or event.get('objectId') is None:
+            return
+
+        if action == 'propertyChange' and event.get('propertyName') not in self._properties[object_type]:
+            return
+
+        occurred_at = event.get('occurredAt', 0)
+        self._set(object_type, str(event['objectId']), occurred_at, action in DELETION_EVENTS)
+        for merged_id in event.get('mergedObjectIds') or []:
+            self._set(object_type, str(merged_id), occurred_at, True)
+
+    def _add_association(self, event):
+        contact_field = CONTACT_ASSOCIATIONS.get(event.get('associationType'))
+        if contact_field is None or event.get(contact_field) is None:
+            return
+        # The contact is read again, with the company it is now associated to
+        self._set(CONTACTS, str(event[contact_field]), event.get('occurredAt', 0), False)
+
+    def _set(self, object_type, uid, occurred_at, deletion):
+        key = (object_type, uid)
+        current = self._pending.get(key)
+        if current is None or current[0] <= occurred_at:
+            self._pending[key] = (occurred_at, deletion)
+
+    def _is_duplicate(self, event_id):
+        if event_id is None:
+            return False
+        if event_id in self._seen:
+            return True
+        self._seen[event_id] = True
+        if len(self._seen) > SEEN_EVENTS_SIZE:
+            self._seen.popitem(last=False)
+        return False
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.flush()